@@ -0,0 +1,289 @@
+"""端到端离线压测：用httpx.MockTransport模拟e621，直接驱动插件的命令和LLM工具。
+
+需要装好AstrBot和httpx，不需要联网：
+    python benchmarks/bench_plugin.py --latency 0.05 --error-rate 0.01 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import pathlib
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+import types
+
+import httpx
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+PACKAGE = "astrbot_plugin_e621_finder"
+BASE_URL = "https://e621.test/"
+POST_PATH_PATTERN = re.compile(r"^/posts/(\d+)\.json$")
+
+
+def load_plugin_package():
+    # 插件是按包加载的（模块里全是相对导入），这里手动把仓库目录注册成包
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [str(ROOT)]
+    sys.modules[PACKAGE] = package
+    return (
+        importlib.import_module(f"{PACKAGE}.main"),
+        importlib.import_module(f"{PACKAGE}.utils"),
+        importlib.import_module(f"{PACKAGE}.metrics"),
+    )
+
+
+class FakeE621:
+    """假的e621接口，延迟、错误率、每页帖子数和帖子体积都可以调。"""
+
+    def __init__(self, args: argparse.Namespace):
+        self.latency = args.latency
+        self.error_rate = args.error_rate
+        self.max_posts = args.posts
+        self.description = "lorem ipsum " * (args.description_size // 12)
+        self.image = b"\0" * args.image_size
+        self.random = random.Random(args.seed)
+        self.requests = 0
+
+    def make_post(self, id: int) -> dict:
+        md5 = f"{id:032x}"
+        return {
+            "id": id,
+            "created_at": "2024-01-01T00:00:00.000-05:00",
+            "file": {
+                "width": 1920,
+                "height": 1080,
+                "ext": "png",
+                "size": len(self.image),
+                "md5": md5,
+                "url": f"https://static.e621.test/data/{md5}.png",
+            },
+            "preview": {"url": f"https://static.e621.test/preview/{md5}.jpg"},
+            "sample": {
+                "has": True,
+                "url": f"https://static.e621.test/sample/{md5}.jpg",
+            },
+            "score": {"up": id % 97, "down": -(id % 7), "total": id % 97 - id % 7},
+            "tags": {
+                "general": [f"general_tag_{i}" for i in range(40)],
+                "species": ["canine", "mammal"],
+                "character": [f"character_{id % 13}"],
+                "artist": [f"artist_{id % 31}"],
+                "meta": ["hi_res"],
+            },
+            "rating": "sqe"[id % 3],
+            "fav_count": id % 500,
+            "comment_count": id % 20,
+            "description": self.description,
+            "relationships": {"parent_id": None, "children": []},
+            "flags": {"pending": False, "deleted": False},
+            "sources": [f"https://example.test/{id}"],
+        }
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+        if self.random.random() < self.error_rate:
+            return httpx.Response(503, headers={"Retry-After": "0"})
+        path = request.url.path
+        if request.url.host.startswith("static."):
+            return httpx.Response(200, content=self.image)
+        if path == "/posts/random.json":
+            return httpx.Response(
+                200, json={"post": self.make_post(self.random.randint(1, 10**6))}
+            )
+        match = POST_PATH_PATTERN.match(path)
+        if match:
+            return httpx.Response(200, json={"post": self.make_post(int(match[1]))})
+        if path == "/posts.json":
+            limit = min(int(request.url.params.get("limit", 75)), self.max_posts)
+            start = self.random.randint(1, 10**6)
+            return httpx.Response(
+                200,
+                json={"posts": [self.make_post(start + i) for i in range(limit)]},
+            )
+        return httpx.Response(200, text="")
+
+
+class FakeEvent:
+    def __init__(self, group: str):
+        self.group = group
+        self.sent = 0
+
+    def get_group_id(self):
+        return self.group
+
+    def get_sender_id(self):
+        return f"{self.group}-user"
+
+    def get_platform_name(self):
+        return "benchmark"
+
+    def get_self_id(self):
+        return "0"
+
+    def plain_result(self, text):
+        return text
+
+    def chain_result(self, chain):
+        return chain
+
+    async def send(self, chain):
+        self.sent += 1
+
+
+def load_config(overrides: dict) -> dict:
+    with open(ROOT / "_conf_schema.json", encoding="utf8") as file:
+        schema = json.load(file)
+    return {key: item["default"] for key, item in schema.items()} | overrides
+
+
+def percentile(samples: list[float], fraction: float) -> float:
+    return samples[min(int(fraction * len(samples)), len(samples) - 1)]
+
+
+async def run_scenario(name, operation, total: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+
+    async def one(index: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await operation(index)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(index) for index in range(total)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(
+        f"{name:<24} {total / elapsed:8.1f} op/s  "
+        f"p50={percentile(latencies, 0.5) * 1000:7.2f}ms  "
+        f"p95={percentile(latencies, 0.95) * 1000:7.2f}ms  "
+        f"p99={percentile(latencies, 0.99) * 1000:7.2f}ms"
+    )
+
+
+async def drain(generator):
+    async for _ in generator:
+        pass
+
+
+def micro(name: str, case, number: int):
+    seconds = min(timeit.repeat(case, number=number, repeat=5))
+    print(f"{name:<24} {seconds / number * 1e6:8.3f} µs/op")
+
+
+async def main(args: argparse.Namespace):
+    random.seed(args.seed)
+    main_module, utils, metrics_module = load_plugin_package()
+    fake = FakeE621(args)
+    plugin = main_module.RandomPostPlugin(
+        types.SimpleNamespace(),
+        load_config(
+            {
+                "base_url": BASE_URL,
+                "rate_limit_per_second": 0,
+                "http_warm_up": False,
+                "metrics_dump_seconds": 0,
+                "search_delivery": "separate",
+                "mirror_dump_path": args.mirror_dump,
+                "tag_dump_path": args.tag_dump,
+                "prefetch_batch_size": args.prefetch_batch_size,
+            }
+        ),
+    )
+    plugin.client = httpx.AsyncClient(
+        transport=httpx.MockTransport(fake), headers=plugin.client.headers
+    )
+    if plugin.image_cache is not None:
+        plugin.image_cache.client = plugin.client
+    await plugin.initialize()
+    if plugin.mirror_task is not None:
+        await plugin.mirror_task
+    if plugin.tag_task is not None:
+        await plugin.tag_task
+    groups = [str(10000 + index) for index in range(args.groups)]
+    popular_ids = list(range(1, args.popular + 1))
+
+    def event(index: int):
+        return FakeEvent(groups[index % len(groups)])
+
+    print(
+        f"latency={args.latency}s error_rate={args.error_rate} "
+        f"concurrency={args.concurrency} requests={args.requests}"
+    )
+    scenarios = {
+        "command random": lambda i: drain(plugin.command_random_post(event(i), "male")),
+        "command view": lambda i: drain(
+            plugin.command_fetch_post(event(i), random.choice(popular_ids))
+        ),
+        "command search": lambda i: drain(
+            plugin.command_search_post(event(i), "male", args.count, i % 3 + 1)
+        ),
+        "tool get_random_image": lambda i: plugin.get_random_image(event(i), ["male"]),
+        "tool view_post": lambda i: plugin.view_post(
+            event(i), random.choice(popular_ids)
+        ),
+        "tool search_posts": lambda i: plugin.search_posts(
+            event(i), ["male"], args.count, i % 3 + 1
+        ),
+    }
+    for name, operation in scenarios.items():
+        await run_scenario(name, operation, args.requests, args.concurrency)
+    print(f"fake API requests: {fake.requests}")
+
+    group = groups[0]
+    post = (await plugin.fetch_post_by_id(1, group))[0]
+    micro("format_tags", lambda: plugin.format_tags("male, solo", group), 20_000)
+    micro(
+        "render_template",
+        lambda: plugin.POST_TEMPLATE.render(post, {"RATING": "Safe"}),
+        20_000,
+    )
+    micro("format_post", lambda: utils.format_post(post, plugin.POST_TEMPLATE), 5_000)
+    if plugin.tag_index.loaded:
+        micro("tag_index.complete", lambda: plugin.tag_index.complete("ma", 10), 2_000)
+    micro("read_group_data", lambda: utils.read_group_data(group), 20_000)
+
+    if args.metrics:
+        print(metrics_module.format_metrics(metrics_module.metrics.snapshot()))
+    await plugin.terminate()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--posts", type=int, default=320, help="每页最多返回几个帖子")
+    parser.add_argument("--description-size", type=int, default=2000)
+    parser.add_argument("--image-size", type=int, default=200_000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--count", type=int, default=3, help="搜索每页帖子数")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--popular", type=int, default=50, help="view命令的热门帖子数")
+    parser.add_argument("--seed", type=int, default=621)
+    parser.add_argument(
+        "--prefetch-batch-size", type=int, default=20, help="填0关闭随机图预取"
+    )
+    parser.add_argument(
+        "--mirror-dump", default="", help="用本地镜像回答查询（posts导出文件路径）"
+    )
+    parser.add_argument(
+        "--tag-dump", default="", help="加载本地标签词典（tags导出文件所在目录）"
+    )
+    parser.add_argument("--metrics", action="store_true", help="最后打印插件自身的统计")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    # 插件数据目录跟着AstrBot的工作目录走，压测时放到临时目录里
+    os.chdir(tempfile.mkdtemp(prefix="e621-bench-"))
+    asyncio.run(main(arguments))
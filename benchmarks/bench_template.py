@@ -0,0 +1,43 @@
+"""对比 render_template 和预编译渲染计划的耗时：python benchmarks/bench_template.py"""
+
+import importlib.util
+import pathlib
+import timeit
+
+spec = importlib.util.spec_from_file_location(
+    "e621_template_parser", pathlib.Path(__file__).parent.parent / "parser.py"
+)
+parser = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(parser)
+
+TEMPLATE = "\n#{id} [❤️{score.total|score} ⭐{fav_count} 📻{comment_count}]（{RATING}）\n\n{description}"
+POST = {
+    "id": 1234567,
+    "score": {"up": 120, "down": -3, "total": 117},
+    "fav_count": 256,
+    "comment_count": 12,
+    "rating": "s",
+    "description": "A fairly long description " * 8,
+    "tags": {"general": ["male", "solo"] * 20},
+}
+RATING = {"RATING": "Safe"}
+NUMBER = 100_000
+
+
+def main():
+    compiled = parser.compile_template(TEMPLATE)
+    assert compiled.render(POST, RATING) == parser.render_template(
+        TEMPLATE, POST | RATING
+    )
+    cases = {
+        "render_template": lambda: parser.render_template(TEMPLATE, POST | RATING),
+        "CompiledTemplate.render": lambda: compiled.render(POST, RATING),
+        "compile_template": lambda: parser.compile_template(TEMPLATE),
+    }
+    for name, case in cases.items():
+        seconds = min(timeit.repeat(case, number=NUMBER, repeat=5))
+        print(f"{name:<24} {seconds / NUMBER * 1e6:8.3f} µs/op")
+
+
+if __name__ == "__main__":
+    main()
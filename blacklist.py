@@ -0,0 +1,180 @@
+import hashlib
+import math
+import operator
+
+from .models import Post
+
+SCORE_OPERATORS = {
+    "<=": operator.le,
+    ">=": operator.ge,
+    "<": operator.lt,
+    ">": operator.gt,
+    "=": operator.eq,
+}
+# e621单页最多返回这么多帖子
+MAX_PAGE_LIMIT = 320
+# 还没有观测数据时假设有这么多帖子会被黑名单刷掉
+INITIAL_REJECTION_RATE = 0.25
+
+
+class BlacklistLine:
+    """黑名单的一行：行内所有条件同时满足才算命中，标签条件都编译成位掩码。"""
+
+    __slots__ = (
+        "required",
+        "excluded",
+        "any_of",
+        "ratings",
+        "excluded_ratings",
+        "score_checks",
+        "inert",
+    )
+
+    def __init__(self):
+        self.required = 0
+        self.excluded = 0
+        self.any_of = 0
+        self.ratings: set[str] = set()
+        self.excluded_ratings: set[str] = set()
+        self.score_checks: list[tuple] = []
+        # 含有不支持的元标签的行不生效，宁可少拦也不要误拦
+        self.inert = False
+
+    def matches(self, mask: int, post: Post) -> bool:
+        if self.inert:
+            return False
+        if mask & self.required != self.required or mask & self.excluded:
+            return False
+        if self.any_of and not mask & self.any_of:
+            return False
+        if self.ratings and post.rating not in self.ratings:
+            return False
+        if post.rating in self.excluded_ratings:
+            return False
+        return all(check(post.score, value) for check, value in self.score_checks)
+
+
+def parse_score_check(condition: str) -> tuple | None:
+    for symbol, check in SCORE_OPERATORS.items():
+        if condition.startswith(symbol):
+            condition = condition[len(symbol) :]
+            break
+    else:
+        check = operator.eq
+    try:
+        return (check, int(condition))
+    except ValueError:
+        return None
+
+
+class Blacklist:
+    """按e621黑名单语法编译好的一组规则，每行一条，命中任意一行的帖子会被过滤掉。"""
+
+    def __init__(self, lines: list[str]):
+        self.vocabulary: dict[str, int] = {}
+        self.lines = [self.compile_line(line) for line in lines if line.split()]
+        self.rejection_rate = INITIAL_REJECTION_RATE
+        # 同样的查询，黑名单不同翻出来的页就不同，搜索游标要按它分开；落进快照，不能用hash()
+        self.fingerprint = hashlib.blake2b(
+            "\n".join(" ".join(line.split()) for line in lines if line.split()).encode(
+                "utf8"
+            ),
+            digest_size=8,
+        ).hexdigest()
+
+    def bit(self, tag: str) -> int:
+        if tag not in self.vocabulary:
+            self.vocabulary[tag] = 1 << len(self.vocabulary)
+        return self.vocabulary[tag]
+
+    def compile_line(self, line: str) -> BlacklistLine:
+        compiled = BlacklistLine()
+        for token in line.lower().split():
+            negated = token.startswith("-")
+            any_of = token.startswith("~")
+            name = token[1:] if negated or any_of else token
+            if name.startswith("rating:"):
+                rating = name[len("rating:") :][:1]
+                (compiled.excluded_ratings if negated else compiled.ratings).add(rating)
+            elif name.startswith("score:") and not negated:
+                check = parse_score_check(name[len("score:") :])
+                if check is None:
+                    compiled.inert = True
+                else:
+                    compiled.score_checks.append(check)
+            elif ":" in name or not name:
+                compiled.inert = True
+            elif negated:
+                compiled.excluded |= self.bit(name)
+            elif any_of:
+                compiled.any_of |= self.bit(name)
+            else:
+                compiled.required |= self.bit(name)
+        return compiled
+
+    @property
+    def empty(self):
+        return not self.lines
+
+    def mask(self, post: Post) -> int:
+        # 只有黑名单里提到过的标签才有位，帖子的其他标签直接跳过
+        vocabulary = self.vocabulary
+        mask = 0
+        for tag in post.tags:
+            bit = vocabulary.get(tag)
+            if bit is not None:
+                mask |= bit
+        return mask
+
+    def matches(self, post: Post) -> bool:
+        mask = self.mask(post)
+        return any(line.matches(mask, post) for line in self.lines)
+
+    def filter(self, posts: list[Post]) -> list[Post]:
+        if self.empty:
+            return posts
+        return [post for post in posts if not self.matches(post)]
+
+    def observe(self, fetched: int, kept: int):
+        if fetched > 0:
+            self.rejection_rate = (
+                0.7 * self.rejection_rate + 0.3 * (fetched - kept) / fetched
+            )
+
+    def fetch_limit(self, count: int) -> int:
+        """按观测到的过滤比例多拉一点，过滤完刚好还能凑满一页。"""
+        if self.empty:
+            return count
+        rate = min(self.rejection_rate, 0.9)
+        return min(count + math.ceil(count * rate / (1 - rate)) + 1, MAX_PAGE_LIMIT)
+
+
+def is_plain_tag(tag: str) -> bool:
+    name = tag[1:] if tag.startswith("-") else tag
+    return (
+        bool(name) and not name.startswith("~") and ":" not in name and "*" not in name
+    )
+
+
+def split_overflow_tags(tags: str, max_tags: int) -> tuple[str, list[str]]:
+    """标签数超过e621的上限时，把多出来的普通标签挪到本地过滤，返回(查询用的标签串, 本地过滤用的黑名单行)。
+
+    先从后往前挪排除标签，还不够再挪正向标签：-x在本地就是黑名单行x，x就是黑名单行-x（没有x的帖子刷掉）。
+    """
+    parts = [tag for tag in tags.split("+") if tag]
+    excess = len(parts) - max_tags
+    if excess <= 0:
+        return tags, []
+    backwards = [
+        index for index in reversed(range(len(parts))) if is_plain_tag(parts[index])
+    ]
+    movable = [index for index in backwards if parts[index].startswith("-")] + [
+        index for index in backwards if not parts[index].startswith("-")
+    ]
+    moved = set(movable[:excess])
+    overflow = [
+        parts[index][1:] if parts[index].startswith("-") else f"-{parts[index]}"
+        for index in sorted(moved)
+    ]
+    kept = [tag for index, tag in enumerate(parts) if index not in moved]
+    return "+".join(kept), overflow
@@ -0,0 +1,120 @@
+import re
+import time
+from collections import OrderedDict
+from typing import Generic, Literal, TypeVar
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from .models import Post
+from .snapshot import Snapshot
+
+V = TypeVar("V")
+
+EndpointClass = Literal["random", "post", "search", "other"]
+
+POST_PATH_PATTERN = re.compile(r"/posts/\d+\.json$")
+
+
+def classify_endpoint(url: str) -> EndpointClass:
+    parts = urlsplit(url)
+    path = parts.path
+    if path.endswith("/posts/random.json"):
+        return "random"
+    if POST_PATH_PATTERN.search(path):
+        return "post"
+    if path.endswith("/posts.json"):
+        # 带order:random的搜索是批量取随机帖子，和随机接口一样不能缓存
+        tags = dict(parse_qsl(parts.query)).get("tags", "")
+        return "random" if "order:random" in tags.split() else "search"
+    return "other"
+
+
+def normalize_url(url: str) -> str:
+    # 参数顺序和标签顺序都不影响e621的结果，统一排一下序当缓存键
+    parts = urlsplit(url)
+    params = sorted(
+        (key, " ".join(sorted(value.split())) if key == "tags" else value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+    )
+    return f"{parts.scheme}://{parts.netloc.lower()}{parts.path}?{urlencode(params)}"
+
+
+class TTLCache(Generic[V]):
+    """按条目数做LRU淘汰、每条带过期时间的缓存。"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[str, tuple[float, V]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> V | None:
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: V, ttl: float):
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self.entries[key] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def export(self) -> dict[str, tuple[float, V]]:
+        # 过期时间换成墙上时间，重启后monotonic时钟不连续
+        now, wall = time.monotonic(), time.time()
+        return {
+            key: (wall + expires - now, value)
+            for key, (expires, value) in self.entries.items()
+            if expires > now
+        }
+
+
+class ResponseCache:
+    """fetch_api的响应缓存，不同类型的接口用不同的TTL，随机接口永不缓存。"""
+
+    def __init__(self, max_entries: int, post_ttl: float, search_ttl: float):
+        self.store: TTLCache[list[Post]] = TTLCache(max_entries)
+        # 上次退出时的快照，内存里没有的再去快照里找
+        self.snapshot: Snapshot | None = None
+        self.ttls: dict[EndpointClass, float] = {
+            "random": 0,
+            "post": post_ttl,
+            "search": search_ttl,
+            "other": 0,
+        }
+
+    def get(self, url: str) -> list[Post] | None:
+        if self.ttls[classify_endpoint(url)] <= 0:
+            return None
+        key = normalize_url(url)
+        posts = self.store.get(key)
+        if posts is None and self.snapshot is not None:
+            restored = self.snapshot.take_page(key)
+            if restored is not None:
+                posts, ttl = restored
+                self.store.put(key, posts, ttl)
+        return posts
+
+    def put(self, url: str, posts: list[Post]):
+        self.store.put(normalize_url(url), posts, self.ttls[classify_endpoint(url)])
+
+    def export(self) -> dict[str, tuple[float, list[Post]]]:
+        return self.store.export()
+
+    @property
+    def hits(self):
+        return self.store.hits
+
+    @property
+    def misses(self):
+        return self.store.misses
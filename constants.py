@@ -1,3 +1,5 @@
+import functools
+
 from astrbot.api.star import StarTools
 
 RATING_LEVEL: dict[str, str] = {
@@ -5,8 +7,37 @@ RATING_LEVEL: dict[str, str] = {
     "q": "Questionable",
     "e": "Explicit",
 }
-PLUGIN_DATA_PATH = StarTools.get_data_dir("astrbot_plugin_e621_finder")
+
+
+# 数据目录第一次用到时才创建，导入本模块不碰文件系统
+@functools.cache
+def get_plugin_data_path():
+    return StarTools.get_data_dir("astrbot_plugin_e621_finder")
+
+
 INITIAL_GROUP_DATA = {
     "rating": "s",
     "constants": ["male"],
+    "blacklist": [],
 }
+# 搜索翻页游标（每页最后一个帖子的ID）保留多久、最多记多少条
+SEARCH_CURSOR_TTL = 600
+SEARCH_CURSOR_MAX_ENTRIES = 1024
+# 支持合并转发消息的平台，其他平台搜索结果逐条发送
+FORWARD_PLATFORMS = {"aiocqhttp"}
+FORWARD_NODE_NAME = "e621"
+# e621图片静态资源地址，本地镜像按md5拼图片URL时用
+STATIC_URL = "https://static1.e621.net"
+# e621单次查询允许的标签数上限
+MAX_QUERY_TAGS = 40
+# 随机图被黑名单刷掉后最多重抽几次
+MAX_RANDOM_DRAWS = 5
+# 搜索被黑名单刷掉后最多补拉几次
+MAX_SEARCH_FETCHES = 3
+# 有黑名单时直接跳页又没有上一页的游标，最多从前面逐页翻这么多页过来，再远就只能按偏移跳
+MAX_SEARCH_WALK = 10
+# 没有预取池时随机图一次抽几张，用来跳过最近发过的帖子
+RANDOM_DRAW_BATCH = 10
+# 标签补全列出几个，不存在的标签给几个相近的写法
+TAG_COMPLETIONS = 10
+TAG_SUGGESTIONS = 3
@@ -0,0 +1,35 @@
+from collections import deque
+
+
+class RecentPosts:
+    """一个群最近发过的帖子ID：定长环形队列加集合，满了就挤掉最早的，内存不随使用量增长。"""
+
+    __slots__ = ("size", "order", "seen")
+
+    def __init__(self, size: int, ids: list[int] = []):
+        self.size = size
+        self.order: deque[int] = deque(maxlen=size)
+        self.seen: set[int] = set()
+        for id in ids[-size:] if size > 0 else ():
+            self.add(id)
+
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def __contains__(self, id: int):
+        return id in self.seen
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, id: int):
+        if not self.enabled or id in self.seen:
+            return
+        if len(self.order) == self.size:
+            self.seen.discard(self.order[0])
+        self.order.append(id)
+        self.seen.add(id)
+
+    def to_list(self) -> list[int]:
+        return list(self.order)
@@ -0,0 +1,123 @@
+import asyncio
+import hashlib
+import os
+from collections import OrderedDict
+
+import httpx
+
+from .models import Post
+
+
+def pick_image_url(post: Post, max_bytes: int) -> tuple[str | None, str]:
+    """选出要发的图片地址和它对应的变体名，原图超出字节预算时改用sample。"""
+    if post.sample_url and (not post.file_url or post.file_size > max_bytes):
+        return post.sample_url, "sample"
+    return post.file_url, "file"
+
+
+def get_image_key(post: Post, url: str, variant: str) -> str:
+    md5 = post.file_md5
+    if not md5:
+        md5 = hashlib.md5(url.encode("utf8")).hexdigest()
+    extension = os.path.splitext(url.split("?")[0])[1] or ".bin"
+    return f"{md5}.{variant}{extension}"
+
+
+def scan_directory(directory: str) -> list[tuple[str, int]]:
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+    # 按修改时间从旧到新排，启动后仍然能按LRU顺序淘汰
+    return [(name, size) for _, name, size in sorted(entries)]
+
+
+def write_file_atomic(path: str, content: bytes):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as file:
+        file.write(content)
+    os.replace(temp_path, path)
+
+
+def remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ImageCache:
+    """按帖子MD5存图片的磁盘缓存，总字节数超过上限时淘汰最久没用过的文件。"""
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        directory: str,
+        max_bytes: int,
+        concurrency: int,
+    ):
+        self.client = client
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.semaphore = asyncio.Semaphore(max(concurrency, 1))
+        self.entries: OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self.downloads: dict[str, asyncio.Task[str]] = {}
+        self.loaded: asyncio.Task | None = None
+
+    async def load(self):
+        if self.loaded is None:
+            self.loaded = asyncio.ensure_future(self.load_index())
+        try:
+            await self.loaded
+        except OSError:
+            # 目录建不出来之类的，下次再试，不要把失败缓存下来
+            self.loaded = None
+            raise
+
+    async def load_index(self):
+        await asyncio.to_thread(os.makedirs, self.directory, exist_ok=True)
+        for name, size in await asyncio.to_thread(scan_directory, self.directory):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    async def get(self, url: str, key: str) -> str:
+        """返回图片在本地的路径，没缓存就下载，同一张图并发请求只下一次。"""
+        await self.load()
+        if key in self.entries:
+            path = os.path.join(self.directory, key)
+            if os.path.exists(path):
+                self.entries.move_to_end(key)
+                return path
+            # 文件被外部删掉了，忘掉这条记录重新下载
+            self.total_bytes -= self.entries.pop(key)
+        task = self.downloads.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.download(url, key))
+            self.downloads[key] = task
+            task.add_done_callback(lambda _: self.downloads.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def download(self, url: str, key: str) -> str:
+        async with self.semaphore:
+            response = await self.client.get(url)
+            response.raise_for_status()
+            content = response.content
+        path = os.path.join(self.directory, key)
+        await asyncio.to_thread(write_file_atomic, path, content)
+        self.entries[key] = len(content)
+        self.total_bytes += len(content)
+        await self.evict()
+        return path
+
+    async def evict(self):
+        expired = []
+        # 刚下载的那张永远留着，哪怕它自己就超过了上限
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            expired.append(os.path.join(self.directory, name))
+        if expired:
+            await asyncio.to_thread(remove_files, expired)
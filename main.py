@@ -1,20 +1,63 @@
+import asyncio
+import os
+import time
 from json import JSONDecodeError
+from typing import Callable
 from urllib.parse import urljoin
 
 import httpx
 
-# from astrbot.api import logger
+from astrbot.api import logger
 from astrbot.api import message_components as Comp
 from astrbot.api.event import AstrMessageEvent, MessageChain, filter
 from astrbot.api.star import Context, Star
 
-from .constants import RATING_LEVEL
+from .blacklist import Blacklist, split_overflow_tags
+from .cache import ResponseCache, TTLCache, classify_endpoint, normalize_url
+from .constants import (
+    FORWARD_NODE_NAME,
+    FORWARD_PLATFORMS,
+    MAX_QUERY_TAGS,
+    MAX_RANDOM_DRAWS,
+    MAX_SEARCH_FETCHES,
+    MAX_SEARCH_WALK,
+    RANDOM_DRAW_BATCH,
+    RATING_LEVEL,
+    SEARCH_CURSOR_MAX_ENTRIES,
+    SEARCH_CURSOR_TTL,
+    TAG_COMPLETIONS,
+    TAG_SUGGESTIONS,
+    get_plugin_data_path,
+)
+from .history import RecentPosts
+from .images import ImageCache, get_image_key, pick_image_url
+from .metrics import format_metrics, metrics, timed
+from .mirror import LocalMirror, build_index, find_latest_dump, needs_rebuild
+from .models import Post
+from .parser import CompiledTemplate, compile_template
+from .prefetch import RandomPostPool
+from .ratelimit import RETRY_STATUS_CODES, SingleFlight, TokenBucket, backoff_delay
+from .scheduler import FairScheduler
+from .snapshot import Snapshot, write_snapshot
+from .storage import write_json_file_atomic
+from .streaming import read_posts
+from .tagindex import TagIndex, build_tag_index, needs_tag_rebuild
+from .upstream import Upstream, UpstreamPool, first_response
 from .utils import (
+    close_group_data,
     compose_rating_map,
+    configure_group_storage,
+    create_http_client,
     filter_empty_string,
     format_post,
+    get_query_limit,
+    get_search_cursor_key,
+    has_order_tag,
+    is_safe_query,
+    load_group_data,
     merge_params,
-    read_group_data,
+    read_group_value,
+    summarize_post,
     write_group_data,
 )
 
@@ -25,18 +68,205 @@ class RandomPostPlugin(Star):
 
     USER_AGENT: str = ""
     BASE_URL: str = ""
+    WARM_UP: bool = False
+    IMAGE_MAX_BYTES: int = 0
     TAG_SEPARATOR: str = ""
-    POST_TEMPLATE: str = ""
+    POST_TEMPLATE: CompiledTemplate = compile_template("")
+    LLM_POST_TEMPLATE: CompiledTemplate = compile_template("")
     MAX_COUNT_POSTS: int = -1
+    MAX_RETRIES: int = 0
+    RETRY_BASE_DELAY: float = 1.0
+    RETRY_MAX_DELAY: float = 10.0
+    SEARCH_DELIVERY: str = "forward"
+    METRICS_DUMP_SECONDS: int = 0
+    MIRROR_DUMP_PATH: str = ""
+    CACHE_SNAPSHOT: bool = False
+    RECENT_POSTS_WINDOW: int = 0
+    TAG_DUMP_PATH: str = ""
 
     def __init__(self, context: Context, config: dict):
         super().__init__(context)
-        self.client = httpx.AsyncClient()
         self.USER_AGENT = config["user_agent"]
-        self.BASE_URL = config["base_url"]
+        base_urls = config["base_url"]
+        # 旧配置里是单个字符串
+        if isinstance(base_urls, str):
+            base_urls = [base_urls]
+        self.upstreams = UpstreamPool(
+            filter_empty_string(base_urls) or ["https://e621.net"],
+            config["hedge_requests"],
+            config["route_safe_groups"],
+        )
+        self.BASE_URL = self.upstreams.primary.base_url
+        self.WARM_UP = config["http_warm_up"]
+        self.warm_up_task: asyncio.Task | None = None
+        self.client = create_http_client(
+            self.USER_AGENT,
+            config["http_max_connections"],
+            config["http_max_keepalive_connections"],
+            config["http_connect_timeout"],
+            config["http_read_timeout"],
+            config["http_pool_timeout"],
+            config["http2"],
+        )
         self.TAG_SEPARATOR = config["tag_separator"]
-        self.POST_TEMPLATE = config["post_template"]
+        self.load_post_template(config["post_template"], config["llm_post_template"])
         self.MAX_COUNT_POSTS = config["max_count_posts"]
+        self.SEARCH_DELIVERY = config["search_delivery"]
+        self.METRICS_DUMP_SECONDS = config["metrics_dump_seconds"]
+        self.metrics_dump_task: asyncio.Task | None = None
+        self.MIRROR_DUMP_PATH = config["mirror_dump_path"]
+        self.mirror = LocalMirror(os.path.join(get_plugin_data_path(), "mirror"))
+        self.mirror_task: asyncio.Task | None = None
+        # 上次刷新失败的原因，/e621-mirror里显示
+        self.mirror_error: str | None = None
+        self.TAG_DUMP_PATH = config["tag_dump_path"]
+        self.tag_index = TagIndex(os.path.join(get_plugin_data_path(), "tags"))
+        self.tag_task: asyncio.Task | None = None
+        self.tag_error: str | None = None
+        self.IMAGE_MAX_BYTES = config["image_max_kb"] * 1024
+        self.image_cache = (
+            ImageCache(
+                self.client,
+                os.path.join(get_plugin_data_path(), "images"),
+                config["image_cache_max_mb"] * 1024 * 1024,
+                config["image_download_concurrency"],
+            )
+            if config["image_cache"]
+            else None
+        )
+        self.MAX_RETRIES = config["max_retries"]
+        self.RETRY_BASE_DELAY = config["retry_base_delay"]
+        self.RETRY_MAX_DELAY = config["retry_max_delay"]
+        self.rate_limiter = TokenBucket(
+            config["rate_limit_per_second"], config["rate_limit_burst"]
+        )
+        self.inflight: SingleFlight[list[Post]] = SingleFlight()
+        self.scheduler = FairScheduler(
+            config["scheduler_max_running"],
+            config["scheduler_group_running"],
+            config["scheduler_max_queued"],
+            config["scheduler_group_queued"],
+        )
+        configure_group_storage(config["storage_backend"])
+        self.response_cache = ResponseCache(
+            config["cache_max_entries"],
+            config["cache_ttl_post"],
+            config["cache_ttl_search"],
+        )
+        self.blacklists: dict[str, tuple[tuple[str, ...], Blacklist]] = {}
+        self.RECENT_POSTS_WINDOW = config["recent_posts_window"]
+        self.recent_posts: dict[str, RecentPosts] = {}
+        self.search_cursors: TTLCache[int] = TTLCache(SEARCH_CURSOR_MAX_ENTRIES)
+        self.CACHE_SNAPSHOT = config["cache_snapshot"]
+        self.snapshot = Snapshot(os.path.join(get_plugin_data_path(), "snapshot"))
+        self.random_pool = RandomPostPool(
+            self.fetch_random_batch,
+            config["prefetch_batch_size"],
+            config["prefetch_low_water"],
+            config["prefetch_idle_seconds"],
+        )
+
+    async def initialize(self):
+        await load_group_data()
+        if self.CACHE_SNAPSHOT:
+            self.restore_snapshot()
+        if self.METRICS_DUMP_SECONDS > 0:
+            self.metrics_dump_task = asyncio.create_task(self.dump_metrics())
+        if self.WARM_UP:
+            self.warm_up_task = asyncio.create_task(self.warm_up())
+        if self.MIRROR_DUMP_PATH:
+            self.mirror_task = asyncio.create_task(self.refresh_mirror())
+        if self.TAG_DUMP_PATH:
+            self.tag_task = asyncio.create_task(self.refresh_tags())
+
+    def snapshot_fingerprint(self) -> dict:
+        # 镜像列表或模板用到的字段变了，快照里的帖子就对不上了
+        return {
+            "base_urls": [upstream.base_url for upstream in self.upstreams.upstreams],
+            "fields": sorted(self.post_fields),
+        }
+
+    def restore_snapshot(self):
+        # 只读页面表、映射帖子文件，帖子等缓存未命中时才按ID解码
+        if not self.snapshot.load(self.snapshot_fingerprint()):
+            return
+        self.response_cache.snapshot = self.snapshot
+        now = time.time()
+        for key, (expires, id) in self.snapshot.cursors.items():
+            self.search_cursors.put(key, id, expires - now)
+
+    async def save_snapshot(self):
+        pages = self.response_cache.export()
+        # 快照里还没被用到的页面没过期的话也带上
+        for key, page in self.snapshot.remaining_pages().items():
+            pages.setdefault(key, page)
+        cursors = self.search_cursors.export()
+        self.response_cache.snapshot = None
+        self.snapshot.close()
+        await asyncio.to_thread(
+            write_snapshot,
+            self.snapshot.directory,
+            pages,
+            cursors,
+            self.snapshot_fingerprint(),
+        )
+
+    async def refresh_tags(self):
+        self.tag_error = None
+        try:
+            if not self.tag_index.loaded:
+                await asyncio.to_thread(self.tag_index.load)
+            tags = find_latest_dump(self.TAG_DUMP_PATH, "tags-")
+            # 填的是单个文件就只有标签没有别名
+            aliases = (
+                find_latest_dump(self.TAG_DUMP_PATH, "tag_aliases-")
+                if os.path.isdir(self.TAG_DUMP_PATH)
+                else None
+            )
+            directory = self.tag_index.directory
+            if tags and await asyncio.to_thread(
+                needs_tag_rebuild, tags, aliases, directory
+            ):
+                await asyncio.to_thread(build_tag_index, tags, aliases, directory)
+                await asyncio.to_thread(self.tag_index.load)
+        except Exception as e:
+            logger.exception("刷新本地标签词典失败")
+            self.tag_error = f"{type(e).__name__}: {e}"
+
+    async def refresh_mirror(self):
+        # 先把已有的索引映射进来，再看有没有更新的导出需要重建
+        self.mirror_error = None
+        try:
+            if not self.mirror.loaded:
+                await asyncio.to_thread(self.mirror.load)
+            dump = find_latest_dump(self.MIRROR_DUMP_PATH)
+            if dump and await asyncio.to_thread(
+                needs_rebuild, dump, self.mirror.directory
+            ):
+                await asyncio.to_thread(build_index, dump, self.mirror.directory)
+                await asyncio.to_thread(self.mirror.load)
+        except Exception as e:
+            # 后台任务的异常没人await，不记下来就悄悄没了
+            logger.exception("刷新本地镜像失败")
+            self.mirror_error = f"{type(e).__name__}: {e}"
+
+    async def dump_metrics(self):
+        # 数据目录顶层的*.json都会被当成群设置，统计文件放到子目录里
+        directory = os.path.join(get_plugin_data_path(), "metrics")
+        await asyncio.to_thread(os.makedirs, directory, exist_ok=True)
+        path = os.path.join(directory, "metrics.json")
+        while True:
+            await asyncio.sleep(self.METRICS_DUMP_SECONDS)
+            await asyncio.to_thread(write_json_file_atomic, path, metrics.snapshot())
+
+    async def warm_up(self):
+        # 提前建好到base_url的长连接，重启后第一条命令就不用再等TLS握手
+        for upstream in self.upstreams.upstreams:
+            try:
+                await self.rate_limiter.acquire()
+                await self.client.head(upstream.base_url)
+            except httpx.HTTPError:
+                pass
 
     # region 命令&LLM工具
     @filter.command(
@@ -53,26 +283,33 @@ class RandomPostPlugin(Star):
         },
         desc="从某插画网站获取一张随机图",
     )
+    @timed("command.random")
     async def command_random_post(self, event: AstrMessageEvent, tags: str):
         yield self.tip_fetching_random_image(event, tags)
         try:
-            post = await self.fetch_random_post(
-                self.format_tags(tags, event.get_group_id())
-            )
-            yield event.chain_result(format_post(post[0], "random", self.POST_TEMPLATE))
+            async with self.admit(event, "random", tags):
+                post = await self.fetch_random_post(
+                    self.format_tags(tags, event.get_group_id()), event.get_group_id()
+                )
+                chain = await self.prepare_post(post[0])
+            yield event.chain_result(chain)
         except Exception as e:
             yield event.plain_result(str(e))
 
     @filter.command("fetch-post", alias={"fetch", "post", "查看", "view"})
+    @timed("command.view")
     async def command_fetch_post(self, event: AstrMessageEvent, id: int):
         yield self.tip_fetching_exact_image(event, id)
         try:
-            post = await self.fetch_post_by_id(id)
-            yield event.chain_result(format_post(post[0], "post", self.POST_TEMPLATE))
+            async with self.admit(event, "view", id):
+                post = await self.fetch_post_by_id(id, event.get_group_id())
+                chain = await self.prepare_post(post[0])
+            yield event.chain_result(chain)
         except Exception as e:
             yield event.plain_result(str(e))
 
     @filter.command("search-post", alias={"search", "find", "搜索", "查找"})
+    @timed("command.search")
     async def command_search_post(
         self, event: AstrMessageEvent, tags: str, count: int, page: int = 1
     ):
@@ -82,37 +319,46 @@ class RandomPostPlugin(Star):
                 f"命题 {count}∈(0,{self.MAX_COUNT_POSTS}]∩N* 不成立，可能造成刷屏，请修改count的值。"
             )
             return
+        if page < 0:
+            yield event.plain_result(f"命题 {page + 1}∈N* 不成立，请修改page的值。")
+            return
         tags = self.format_tags(tags, event.get_group_id())
-        yield self.tip_searching_image(event, tags)
+        yield self.tip_searching_image(event, tags, count, page)
         try:
-            pages = await self.search_post(count, tags)
-            if page >= len(pages):
-                yield event.plain_result(
-                    f"这个标签下只搜到了{len(pages)}页帖子，请降低page的值或修改tags。"
+            async with self.admit(event, "search", tags, count, page):
+                pageData, last = await self.search_post(
+                    count, tags, event.get_group_id(), page
                 )
-            else:
                 yield event.plain_result(
-                    f"当前在第({page + 1}/{len(pages)})页，更改page参数的值可切换选页。"
+                    f"当前在第{page + 1}页，更改page参数的值可切换选页。"
                 )
-                pageData = pages[page]
-                if len(pageData) < count:
+                if len(pageData) < count and last:
+                    # 上游返回的不满一页说明已经翻到底了，总页数这时候才知道
                     yield event.plain_result(
-                        f"这一页没有那么多帖子，只搜到了{len(pageData)}张。"
+                        f"这一页没有那么多帖子，只搜到了{len(pageData)}张，这个标签下一共{page + 1}页。"
                     )
-                for index in range(len(pageData)):
-                    post = pageData[index]
-                    yield event.chain_result(
-                        format_post(
-                            post,
-                            "post",
-                            self.POST_TEMPLATE,
-                            (index, min(count, len(pageData))),
-                        )
+                elif len(pageData) < count:
+                    yield event.plain_result(
+                        f"这一页有些帖子被黑名单过滤掉了，只剩{len(pageData)}张，后面可能还有。"
                     )
+                tasks = self.schedule_posts(pageData)
+                try:
+                    if self.supports_forward(event):
+                        yield event.chain_result(
+                            self.merge_posts(event, await asyncio.gather(*tasks))
+                        )
+                    else:
+                        # 所有帖子已经在并发准备了，按顺序谁好了就先发谁
+                        for task in tasks:
+                            yield event.chain_result(await task)
+                finally:
+                    for task in tasks:
+                        task.cancel()
         except Exception as e:
             yield event.plain_result(str(e))
 
     @filter.llm_tool()
+    @timed("tool.get_random_image")
     async def get_random_image(self, event: AstrMessageEvent, tags: list[str]):
         """搜索或获取随机图，如果用户强调【随机】就用这个工具，否则使用“search_posts”工具。
 
@@ -120,18 +366,22 @@ class RandomPostPlugin(Star):
             tags(array[string]): The label content of the random graph must consist of all-English keywords. If it is a anime character name, use the official translation.
         """
         try:
-            post = await self.fetch_random_post(
-                self.format_tags(self.TAG_SEPARATOR.join(tags), event.get_group_id())
-            )
-            await event.send(
-                MessageChain(chain=format_post(post[0], "random", self.POST_TEMPLATE))
-            )
-            return f"帖子数据：{post}"
+            async with self.admit(event, "random", tuple(tags)):
+                post = await self.fetch_random_post(
+                    self.format_tags(
+                        self.TAG_SEPARATOR.join(tags), event.get_group_id()
+                    ),
+                    event.get_group_id(),
+                )
+                chain = await self.prepare_post(post[0])
+            await event.send(MessageChain(chain=chain))
+            return f"帖子数据：{summarize_post(post[0], self.LLM_POST_TEMPLATE)}"
         except Exception as e:
             await event.send(MessageChain(chain=[Comp.Plain(str(e))]))
             return str(e)
 
     @filter.llm_tool()
+    @timed("tool.view_post")
     async def view_post(self, event: AstrMessageEvent, id: int):
         """给用户展示一个已知帖子，如果用户提供了类似ID的东西就调用这个工具。
 
@@ -139,16 +389,17 @@ class RandomPostPlugin(Star):
             id(number): The known post ID.
         """
         try:
-            post = await self.fetch_post_by_id(id)
-            await event.send(
-                MessageChain(chain=format_post(post[0], "post", self.POST_TEMPLATE))
-            )
-            return f"帖子数据：{post}"
+            async with self.admit(event, "view", id):
+                post = await self.fetch_post_by_id(id, event.get_group_id())
+                chain = await self.prepare_post(post[0])
+            await event.send(MessageChain(chain=chain))
+            return f"帖子数据：{summarize_post(post[0], self.LLM_POST_TEMPLATE)}"
         except Exception as e:
             await event.send(MessageChain(chain=[Comp.Plain(str(e))]))
             return str(e)
 
     @filter.llm_tool()
+    @timed("tool.search_posts")
     async def search_posts(
         self,
         event: AstrMessageEvent,
@@ -169,31 +420,44 @@ class RandomPostPlugin(Star):
             or not count_per_page % 1 == 0
         ):
             return f"命题 count_per_page∈(0,{self.MAX_COUNT_POSTS}]∩N* 不成立，可能造成刷屏，请修改count_per_page的值。"
+        if page_index < 1:
+            return "命题 page_index∈N* 不成立，请修改page_index的值。"
         try:
-            pages = await self.search_post(
-                count_per_page,
-                self.format_tags(self.TAG_SEPARATOR.join(tags), event.get_group_id()),
-            )
-            if page_index - 1 >= len(pages):
-                return f"这个标签下只搜到了{len(pages)}页帖子，请降低page_index的值或修改tags。"
-            else:
+            async with self.admit(
+                event, "search", tuple(tags), count_per_page, page_index
+            ):
+                pageData, last = await self.search_post(
+                    count_per_page,
+                    self.format_tags(
+                        self.TAG_SEPARATOR.join(tags), event.get_group_id()
+                    ),
+                    event.get_group_id(),
+                    page_index - 1,
+                )
                 result = ""
-                pageData = pages[page_index]
-                if len(pageData) < count_per_page:
-                    result += f"这一页没有那么多帖子，只搜到了{len(pageData)}张。\n"
+                if len(pageData) < count_per_page and last:
+                    result += f"这一页没有那么多帖子，只搜到了{len(pageData)}张，这个标签下一共{page_index}页。\n"
+                elif len(pageData) < count_per_page:
+                    result += f"这一页有些帖子被黑名单过滤掉了，只剩{len(pageData)}张，后面可能还有。\n"
                 for index in range(len(pageData)):
                     post = pageData[index]
-                    result += f"第{index + 1}条帖子：{post};\n"
-                    await event.send(
-                        MessageChain(
-                            chain=format_post(
-                                post,
-                                "post",
-                                self.POST_TEMPLATE,
-                                (index, min(count_per_page, len(pageData))),
+                    result += f"第{index + 1}条帖子：{summarize_post(post, self.LLM_POST_TEMPLATE)};\n"
+                tasks = self.schedule_posts(pageData)
+                try:
+                    if self.supports_forward(event):
+                        await event.send(
+                            MessageChain(
+                                chain=self.merge_posts(
+                                    event, await asyncio.gather(*tasks)
+                                )
                             )
                         )
-                    )
+                    else:
+                        for task in tasks:
+                            await event.send(MessageChain(chain=await task))
+                finally:
+                    for task in tasks:
+                        task.cancel()
                 return result
         except Exception as e:
             return str(e)
@@ -204,10 +468,12 @@ class RandomPostPlugin(Star):
         pass
 
     @rating.command("list", desc="列出所有分级")
+    @timed("command.rating.list")
     async def list_rating(self, event: AstrMessageEvent):
         yield event.plain_result(f"{compose_rating_map()}\n\nall: 允许所有分级")
 
     @rating.command("set", desc="设置当前分级")
+    @timed("command.rating.set")
     async def set_rating(
         self,
         event: AstrMessageEvent,
@@ -223,6 +489,7 @@ class RandomPostPlugin(Star):
             yield event.plain_result("无效分级标签。")
 
     @rating.command("look", desc="查看当前分级")
+    @timed("command.rating.look")
     async def look_rating(self, event: AstrMessageEvent):
         if self.get_current_rating(event.get_group_id()) == "all":
             yield event.plain_result("当前无分级限制。")
@@ -232,6 +499,7 @@ class RandomPostPlugin(Star):
             )
 
     @rating.command("clear", desc="清除分级限制")
+    @timed("command.rating.clear")
     async def clear_rating(self, event: AstrMessageEvent):
         self.set_current_rating(event.get_group_id(), "all")
         yield event.plain_result("已取消分级限制。")
@@ -242,6 +510,7 @@ class RandomPostPlugin(Star):
         pass
 
     @constants.command("add", alias={"+"}, desc="添加恒标签")
+    @timed("command.constants.add")
     async def add_constants(self, event: AstrMessageEvent, tag: str):
         current = self.get_user_constant_tags(event.get_group_id())
         if current.count(tag) > 0:
@@ -252,6 +521,7 @@ class RandomPostPlugin(Star):
             yield event.plain_result("恒标签添加成功！")
 
     @constants.command("delete", alias={"-"}, desc="删除恒标签")
+    @timed("command.constants.delete")
     async def delete_constants(self, event: AstrMessageEvent, tag: str):
         current = self.get_user_constant_tags(event.get_group_id())
         if current.count(tag) == 0:
@@ -262,6 +532,7 @@ class RandomPostPlugin(Star):
             yield event.plain_result("恒标签删除成功！")
 
     @constants.command("replace", alias={"="}, desc="替换恒标签（删除+添加）")
+    @timed("command.constants.replace")
     async def replace_constants(
         self, event: AstrMessageEvent, old_tag: str, new_tag: str
     ):
@@ -279,12 +550,125 @@ class RandomPostPlugin(Star):
         yield event.plain_result(f"替换成功：{old_tag}->{new_tag}")
 
     @constants.command("get", alias={"?"}, desc="查看当前恒标签列表")
+    @timed("command.constants.get")
     async def get_constants(self, event: AstrMessageEvent):
         result = self.TAG_SEPARATOR.join(
             self.get_user_constant_tags(event.get_group_id())
         )
         yield event.plain_result(result if result else "当前没有任何恒标签。")
 
+    # region 黑名单
+    @filter.command_group("blacklist", desc="黑名单相关指令")
+    def blacklist(self):
+        pass
+
+    @blacklist.command(
+        "add", alias={"+"}, desc="添加一行黑名单（行内标签用分隔符隔开）"
+    )
+    @timed("command.blacklist.add")
+    async def add_blacklist(self, event: AstrMessageEvent, line: str):
+        line = " ".join(
+            x.strip().replace(" ", "_").lower()
+            for x in filter_empty_string(line.split(self.TAG_SEPARATOR))
+        )
+        current = self.get_user_blacklist(event.get_group_id())
+        if not line:
+            yield event.plain_result("黑名单不能是空的。")
+        elif current.count(line) > 0:
+            yield event.plain_result("这行黑名单已存在。")
+        else:
+            current.append(line)
+            self.set_user_blacklist(event.get_group_id(), current)
+            yield event.plain_result(f"黑名单添加成功：{line}")
+
+    @blacklist.command("delete", alias={"-"}, desc="按序号删除一行黑名单")
+    @timed("command.blacklist.delete")
+    async def delete_blacklist(self, event: AstrMessageEvent, index: int):
+        current = self.get_user_blacklist(event.get_group_id())
+        if index < 1 or index > len(current):
+            yield event.plain_result(f"命题 {index}∈[1,{len(current)}]∩N* 不成立。")
+        else:
+            line = current.pop(index - 1)
+            self.set_user_blacklist(event.get_group_id(), current)
+            yield event.plain_result(f"黑名单删除成功：{line}")
+
+    @blacklist.command("get", alias={"?"}, desc="查看当前黑名单")
+    @timed("command.blacklist.get")
+    async def get_blacklist_lines(self, event: AstrMessageEvent):
+        current = self.get_user_blacklist(event.get_group_id())
+        yield event.plain_result(
+            "\n".join(f"{index + 1}. {line}" for index, line in enumerate(current))
+            if current
+            else "当前黑名单是空的。"
+        )
+
+    @blacklist.command("clear", desc="清空黑名单")
+    @timed("command.blacklist.clear")
+    async def clear_blacklist(self, event: AstrMessageEvent):
+        self.set_user_blacklist(event.get_group_id(), [])
+        yield event.plain_result("黑名单已清空。")
+
+    # region 统计
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("e621-stats", alias={"stats", "统计"}, desc="查看插件性能统计")
+    async def command_stats(self, event: AstrMessageEvent, action: str = ""):
+        if action == "reset":
+            metrics.reset()
+            yield event.plain_result("性能统计已清空。")
+            return
+        report = format_metrics(metrics.snapshot())
+        yield event.plain_result(
+            f"{report if report else '还没有任何统计数据。'}\n\n"
+            f"响应缓存：命中{self.response_cache.hits}次，未命中{self.response_cache.misses}次"
+        )
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("e621-mirror", alias={"mirror", "镜像"}, desc="查看或刷新本地镜像")
+    async def command_mirror(self, event: AstrMessageEvent, action: str = ""):
+        if not self.MIRROR_DUMP_PATH:
+            yield event.plain_result("没有配置本地镜像的导出文件路径。")
+            return
+        if action == "refresh":
+            if self.mirror_task is not None and not self.mirror_task.done():
+                yield event.plain_result("本地镜像正在刷新，请稍后再看。")
+                return
+            self.mirror_task = asyncio.create_task(self.refresh_mirror())
+            yield event.plain_result("已开始刷新本地镜像。")
+            return
+        if self.mirror.loaded:
+            status = f"本地镜像：{self.mirror.source}，共{self.mirror.count}个帖子，{len(self.mirror.tags)}个标签。"
+        else:
+            status = "本地镜像还没有加载。"
+        if self.mirror_task is not None and not self.mirror_task.done():
+            status += "\n正在刷新。"
+        elif self.mirror_error:
+            status += f"\n上次刷新失败：{self.mirror_error}"
+        yield event.plain_result(status)
+
+    @filter.command("tag-complete", alias={"complete", "补全"}, desc="补全标签")
+    @timed("command.tag_complete")
+    async def command_complete_tag(self, event: AstrMessageEvent, prefix: str):
+        if not self.tag_index.loaded:
+            yield event.plain_result(
+                f"本地标签词典还没有加载，上次刷新失败：{self.tag_error}"
+                if self.tag_error
+                else "本地标签词典还没有加载。"
+            )
+            return
+        prefix = prefix.strip().replace(" ", "_")
+        completions = self.tag_index.complete(prefix, TAG_COMPLETIONS)
+        if not completions:
+            suggestions = self.tag_index.suggest(prefix, TAG_SUGGESTIONS)
+            yield event.plain_result(
+                f"没有以 {prefix} 开头的标签，你是不是想找：{'、'.join(suggestions)}"
+                if suggestions
+                else f"没有以 {prefix} 开头的标签。"
+            )
+            return
+        yield event.plain_result(
+            "\n".join(f"{name}（{count}个帖子）" for name, count in completions)
+        )
+
     # 发提示
     def tip_fetching_random_image(self, event: AstrMessageEvent, tags: str):
         return event.plain_result(
@@ -294,86 +678,382 @@ class RandomPostPlugin(Star):
     def tip_fetching_exact_image(self, event: AstrMessageEvent, id: int):
         return event.plain_result(f"正在获取帖子#{id}：{self.get_url_exact_post(id)}")
 
-    def tip_searching_image(self, event: AstrMessageEvent, tags: str):
+    def tip_searching_image(
+        self, event: AstrMessageEvent, tags: str, count: int, page: int
+    ):
         return event.plain_result(
-            f"正在搜索符合标签 [{tags}] 的帖子：{self.get_url_search_post(tags)}"
+            f"正在搜索符合标签 [{tags}] 的帖子：{self.get_url_search_post(tags, count, page + 1)}"
         )
 
     # 合成一下apiurl
     def get_url_random_post(self, tags: str):
         return self.join_api("posts/random.json", {"tags": tags})
 
+    def get_url_random_batch(self, tags: str, limit: int):
+        return self.join_api(
+            "posts.json",
+            {
+                "tags": f"{tags}+order:random" if tags else "order:random",
+                "limit": limit,
+            },
+        )
+
     def get_url_exact_post(self, id: int):
         return self.join_api(f"posts/{id}.json")
 
-    def get_url_search_post(self, tags: str):
+    def get_url_search_post(self, tags: str, count: int, page: int | str):
         return self.join_api(
             "posts.json",
-            {"tags": tags},
+            {"tags": tags, "limit": count, "page": page},
         )
 
     # region 请求
-    async def fetch_api(self, url: str) -> list[dict]:
+    async def fetch_api(self, url: str, safe: bool = False) -> list[Post]:
+        url = self.upstreams.route(url, safe)
+        cached = self.response_cache.get(url)
+        if cached is not None:
+            return cached
+        if classify_endpoint(url) == "random":
+            # 随机接口每次结果都不一样，不能合并
+            return await self.request_api(url, safe)
+        posts = await self.inflight.do(
+            normalize_url(url), lambda: self.request_api(url, safe)
+        )
+        self.response_cache.put(url, posts)
+        return posts
+
+    async def send_request(self, url: str, safe: bool = False) -> httpx.Response:
+        # 以流的方式拿响应，响应体由调用方决定怎么读，用完要aclose
+        upstreams = self.upstreams.candidates(safe)
+        for index, upstream in enumerate(upstreams):
+            backups = upstreams[index + 1 :]
+            try:
+                response = await self.send_hedged(url, upstream, backups)
+            except httpx.RequestError:
+                if not backups:
+                    raise
+                continue
+            if response.status_code < 500 or not backups:
+                return response
+            # 服务端出错就换下一个镜像
+            await response.aclose()
+        raise AssertionError("unreachable")
+
+    async def send_hedged(
+        self, url: str, upstream: Upstream, backups: list[Upstream]
+    ) -> httpx.Response:
+        delay = self.upstreams.hedge_delay(upstream) if backups else None
+        if delay is None:
+            return await self.send_to(upstream, url)
+        first = asyncio.create_task(self.send_to(upstream, url))
         try:
-            response = await self.client.get(
-                url,
-                headers={
-                    "User-Agent": (
-                        self.USER_AGENT if self.USER_AGENT else "RandomPostPlugin/1.0"
-                    )
-                },
+            done, _ = await asyncio.wait({first}, timeout=delay)
+        except asyncio.CancelledError:
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        # 比这个镜像平时的p95还慢，再向最快的备用镜像发一份，谁先回来用谁
+        backup = min(backups, key=lambda backup: backup.latency)
+        metrics.observe("api.hedge", delay)
+        return await first_response(
+            [first, asyncio.create_task(self.send_to(backup, url))]
+        )
+
+    async def send_to(self, upstream: Upstream, url: str) -> httpx.Response:
+        url = self.upstreams.rebase(url, upstream)
+        for attempt in range(self.MAX_RETRIES + 1):
+            await self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                response = await self.client.send(
+                    self.client.build_request("GET", url), stream=True
+                )
+            except httpx.RequestError:
+                upstream.record(time.perf_counter() - start, False)
+                raise
+            upstream.record(
+                time.perf_counter() - start,
+                response.status_code < 500 and response.status_code != 429,
             )
-            if response.status_code in [404, 200]:
-                try:
-                    data: dict = response.json()
-                    if data.get("success", True):
-                        data = data.get("post", data.get("posts", data))
+            if (
+                response.status_code not in RETRY_STATUS_CODES
+                or attempt == self.MAX_RETRIES
+            ):
+                break
+            delay = backoff_delay(
+                attempt, self.RETRY_BASE_DELAY, self.RETRY_MAX_DELAY, response
+            )
+            if delay is None:
+                # Retry-After太长，不占着名额干等，直接把错误状态交给调用方
+                break
+            await response.aclose()
+            await asyncio.sleep(delay)
+        return response
+
+    async def request_api(self, url: str, safe: bool = False) -> list[Post]:
+        endpoint = classify_endpoint(url)
+        start = time.perf_counter()
+        try:
+            response = await self.send_request(url, safe)
+            try:
+                if response.status_code in [404, 200]:
+                    try:
+                        data = await read_posts(
+                            response.aiter_bytes(), get_query_limit(url)
+                        )
+                        if isinstance(data, dict):
+                            if not data.get("success", True):
+                                raise ValueError("未搜索到任何帖子。")
+                            data = data.get("post", data.get("posts", data))
                         if len(data) == 0:
                             raise ValueError("未搜索到任何帖子。")
                         else:
-                            return [data] if isinstance(data, dict) else data
-                    else:
-                        raise ValueError("未搜索到任何帖子。")
-                except JSONDecodeError:
-                    raise ValueError("请求失败，API未返回帖子数据。")
-            else:
-                raise ValueError(
-                    f"请求失败，来自API的响应无效，状态码：{response.status_code}"
+                            return [
+                                Post.from_api(item, self.post_fields)
+                                for item in ([data] if isinstance(data, dict) else data)
+                            ]
+                    except JSONDecodeError:
+                        raise ValueError("请求失败，API未返回帖子数据。")
+                else:
+                    raise ValueError(
+                        f"请求失败，来自API的响应无效，状态码：{response.status_code}"
+                    )
+            finally:
+                # 攒够帖子提前停止读取时，剩下的响应体直接丢掉
+                await response.aclose()
+                metrics.observe(
+                    f"api.{endpoint}.{response.status_code}",
+                    time.perf_counter() - start,
+                    response.status_code not in [404, 200],
                 )
         except httpx.RequestError:
+            metrics.observe(
+                f"api.{endpoint}.network", time.perf_counter() - start, True
+            )
             raise Exception("请求失败，服务端网络问题。")
 
-    async def fetch_random_post(self, tags: str):
-        return await self.fetch_api(self.get_url_random_post(tags))
-
-    async def fetch_post_by_id(self, id: int):
-        return await self.fetch_api(self.get_url_exact_post(id))
-
-    async def search_post(self, count: int, tags: str) -> list[list[dict]]:
-        posts = await self.fetch_api(self.get_url_search_post(tags))
-        pages = []
-        current_page = []
-        for index in range(len(posts)):
-            current_post = posts[index]
-            if (index + 1) % count == 0:
-                if len(current_page) > 0:
-                    pages.append(current_page)
-                current_page = []
-            current_page.append(current_post)
-        if len(current_page) > 0:
-            pages.append(current_page)
-        return pages
+    async def fetch_random_post(self, tags: str, group: str):
+        self.check_tags(tags)
+        tags, overflow = split_overflow_tags(tags, MAX_QUERY_TAGS)
+        blacklist = self.get_blacklist(group, overflow)
+        recent = self.get_recent_posts(group)
+        repeats: list[Post] = []
+
+        def accept(post: Post):
+            if not blacklist.empty and blacklist.matches(post):
+                return False
+            if post.id in recent:
+                repeats.append(post)
+                return False
+            return True
+
+        for _ in range(MAX_RANDOM_DRAWS):
+            post = await self.draw_random_post(tags, accept)
+            if post is not None:
+                break
+        else:
+            # 标签太窄、能抽到的都发过了，那就宁可重复也别报错
+            if not repeats:
+                raise ValueError("抽到的帖子都被黑名单过滤掉了，请修改tags或黑名单。")
+            post = repeats[0]
+        if recent.enabled and post.id not in recent:
+            recent.add(post.id)
+            write_group_data(group, "recent_posts", recent.to_list())
+        return [post]
+
+    async def draw_random_post(
+        self, tags: str, accept: Callable[[Post], bool]
+    ) -> Post | None:
+        # 一次抽一批，挑第一个能发的，省得一个个来回请求
+        if self.mirror.loaded:
+            posts = await asyncio.to_thread(
+                self.mirror.random, tags, RANDOM_DRAW_BATCH, self.post_fields
+            )
+            if posts:
+                return next((post for post in posts if accept(post)), None)
+        if self.random_pool.enabled:
+            return await self.random_pool.take(tags, accept)
+        if self.RECENT_POSTS_WINDOW > 0:
+            posts = await self.fetch_api(
+                self.get_url_random_batch(tags, RANDOM_DRAW_BATCH),
+                is_safe_query(tags),
+            )
+        else:
+            posts = await self.fetch_api(
+                self.get_url_random_post(tags), is_safe_query(tags)
+            )
+        return next((post for post in posts if accept(post)), None)
+
+    async def fetch_random_batch(self, tags: str):
+        return await self.fetch_api(
+            self.get_url_random_batch(tags, self.random_pool.batch_size),
+            is_safe_query(tags),
+        )
+
+    async def fetch_post_by_id(self, id: int, group: str):
+        post = self.mirror.get(id, self.post_fields)
+        if post is not None:
+            return [post]
+        return await self.fetch_api(
+            self.get_url_exact_post(id), self.get_current_rating(group) == "s"
+        )
+
+    async def fetch_search_page(
+        self, tags: str, limit: int, page: int | str
+    ) -> list[Post]:
+        # 本地镜像答不了或者没搜到（导出是旧的）再走在线API
+        if self.mirror.loaded:
+            posts = await asyncio.to_thread(
+                self.mirror.search, tags, limit, page, self.post_fields
+            )
+            if posts:
+                return posts
+        return await self.fetch_api(
+            self.get_url_search_post(tags, limit, page), is_safe_query(tags)
+        )
+
+    async def search_post(
+        self, count: int, tags: str, group: str, page: int = 0
+    ) -> tuple[list[Post], bool]:
+        """返回(这一页的帖子, 是否已经翻到底)。"""
+        self.check_tags(tags)
+        query_tags, overflow = split_overflow_tags(tags, MAX_QUERY_TAGS)
+        blacklist = self.get_blacklist(group, overflow)
+
+        def has_cursor(page: int) -> bool:
+            return page == 0 or (
+                self.search_cursors.get(
+                    get_search_cursor_key(tags, count, page - 1, blacklist.fingerprint)
+                )
+                is not None
+            )
+
+        start = page
+        if not blacklist.empty and not has_order_tag(tags):
+            # 黑名单会刷掉帖子，按count算偏移跳页的话页和页之间会重叠。没有上一页的游标，
+            # 就从最近一个有游标的页（或者第一页）往后逐页翻过来，顺便把游标都记下
+            while not has_cursor(start) and page - start < MAX_SEARCH_WALK:
+                start -= 1
+            if not has_cursor(start):
+                start = page
+        for current in range(start, page):
+            posts, last = await self.search_page(
+                count, tags, query_tags, blacklist, current, walking=True
+            )
+            if last:
+                # 中间整页被刷掉的页不算数，翻到底那页要是空的也不算
+                total = current + 1 if posts else current
+                if not total:
+                    raise ValueError(
+                        "这个标签下的帖子都被黑名单过滤掉了，请修改tags或黑名单。"
+                    )
+                raise ValueError(f"这个标签下一共只有{total}页。")
+        return await self.search_page(count, tags, query_tags, blacklist, page)
+
+    async def search_page(
+        self,
+        count: int,
+        tags: str,
+        query_tags: str,
+        blacklist: Blacklist,
+        page: int,
+        walking: bool = False,
+    ) -> tuple[list[Post], bool]:
+        # 只下载要展示的这一页；上一页的游标还在的话用 b<id> 翻页，服务端不用再数偏移
+        cursor = (
+            self.search_cursors.get(
+                get_search_cursor_key(tags, count, page - 1, blacklist.fingerprint)
+            )
+            if page > 0 and not has_order_tag(tags)
+            else None
+        )
+        page_param = f"b{cursor}" if cursor is not None else page + 1
+        # 按游标翻页时才能多拉、接着拉；直接跳页只能按count算偏移
+        can_continue = not has_order_tag(tags) and (page == 0 or cursor is not None)
+        limit = blacklist.fetch_limit(count) if can_continue else count
+        posts: list[Post] = []
+        fetched: list[Post] = []
+        # 上游返回的不满limit条才算真的翻到底，被黑名单刷掉的不算
+        last = False
+        for attempt in range(MAX_SEARCH_FETCHES):
+            try:
+                fetched = await self.fetch_search_page(query_tags, limit, page_param)
+            except ValueError:
+                if attempt == 0:
+                    raise
+                last = True
+                break
+            kept = blacklist.filter(fetched)
+            blacklist.observe(len(fetched), len(kept))
+            posts += kept
+            last = len(fetched) < limit
+            if len(posts) >= count or last or not can_continue or blacklist.empty:
+                break
+            page_param = f"b{fetched[-1].id}"
+        if not posts:
+            # 整页都被刷掉了，游标记到最后拉到的帖子，翻下一页（或者往后逐页翻）时从它后面接着拉
+            if fetched and not has_order_tag(tags):
+                self.search_cursors.put(
+                    get_search_cursor_key(tags, count, page, blacklist.fingerprint),
+                    fetched[-1].id,
+                    SEARCH_CURSOR_TTL,
+                )
+            if walking:
+                return [], last
+            raise ValueError("这一页的帖子都被黑名单过滤掉了，请翻页或修改黑名单。")
+        if len(posts) >= count:
+            self.search_cursors.put(
+                get_search_cursor_key(tags, count, page, blacklist.fingerprint),
+                posts[count - 1].id,
+                SEARCH_CURSOR_TTL,
+            )
+        return posts[:count], last and len(posts) <= count
+
+    def get_blacklist(self, group: str, overflow: list[str] = []) -> Blacklist:
+        # 按群缓存编译好的黑名单，黑名单内容变了才重新编译
+        lines = tuple(self.get_user_blacklist(group))
+        cached = self.blacklists.get(group)
+        if cached is None or cached[0] != lines:
+            cached = self.blacklists[group] = (lines, Blacklist(list(lines)))
+        if overflow:
+            # 超出标签上限被挪出查询的标签，每个都当成单独的一行
+            return Blacklist(list(lines) + overflow)
+        return cached[1]
+
+    def get_recent_posts(self, group: str) -> RecentPosts:
+        recent = self.recent_posts.get(group)
+        if recent is None:
+            recent = self.recent_posts[group] = RecentPosts(
+                self.RECENT_POSTS_WINDOW, read_group_value(group, "recent_posts", [])
+            )
+        return recent
 
     def format_tags(self, userRawTags: str, group: str):
         return "+".join(
             [
-                x.replace(" ", "_")
+                self.tag_index.canonical(x.replace(" ", "_"))
                 for x in self.compose_total_tags(
                     userRawTags.split(self.TAG_SEPARATOR), group
                 )
             ]
         )
 
+    def check_tags(self, tags: str):
+        # 本地词典里没有的标签请求了也只会搜不到，直接给出相近的写法
+        unknown = self.tag_index.unknown(tags)
+        if not unknown:
+            return
+        hints = []
+        for tag in unknown:
+            suggestions = self.tag_index.suggest(tag, TAG_SUGGESTIONS)
+            hints.append(
+                f"{tag}（你是不是想找：{'、'.join(suggestions)}）"
+                if suggestions
+                else tag
+            )
+        raise ValueError(f"这些标签不存在：{'，'.join(hints)}")
+
     def compose_total_tags(self, userTags: list[str], group: str) -> list[str]:
         return (
             filter_empty_string(userTags)
@@ -385,20 +1065,104 @@ class RandomPostPlugin(Star):
             )
         )
 
+    async def prepare_post(
+        self,
+        post: Post,
+        index: tuple[int, int] | None = None,
+    ):
+        image_path = None
+        if self.image_cache is not None:
+            url, variant = pick_image_url(post, self.IMAGE_MAX_BYTES)
+            if url:
+                try:
+                    image_path = await self.image_cache.get(
+                        url, get_image_key(post, url, variant)
+                    )
+                except (httpx.HTTPError, OSError):
+                    # 插件自己没下下来或者存不下（磁盘满、目录不可写）就退回发URL，让平台那边再试一次
+                    pass
+        return format_post(post, self.POST_TEMPLATE, index, image_path)
+
+    def schedule_posts(self, posts: list[Post]) -> list[asyncio.Task]:
+        # 并发准备整页帖子，图片下载的并发数由图片缓存自己限制
+        return [
+            asyncio.create_task(self.prepare_post(post, (index, len(posts))))
+            for index, post in enumerate(posts)
+        ]
+
+    def admit(self, event: AstrMessageEvent, *command):
+        # 私聊没有群号，按用户单独排队
+        group = event.get_group_id() or f"user:{event.get_sender_id()}"
+        return self.scheduler.slot(group, (event.get_sender_id(), *command))
+
+    def supports_forward(self, event: AstrMessageEvent):
+        return (
+            self.SEARCH_DELIVERY == "forward"
+            and event.get_platform_name() in FORWARD_PLATFORMS
+        )
+
+    def merge_posts(
+        self,
+        event: AstrMessageEvent,
+        chains: list[list[Comp.BaseMessageComponent]],
+    ) -> list[Comp.BaseMessageComponent]:
+        return [
+            Comp.Nodes(
+                [
+                    Comp.Node(
+                        uin=event.get_self_id(), name=FORWARD_NODE_NAME, content=chain
+                    )
+                    for chain in chains
+                ]
+            )
+        ]
+
+    def load_post_template(self, template: str, llm_template: str):
+        # 模板只在加载配置时编译一次，格式化帖子时直接按渲染计划走
+        self.POST_TEMPLATE = compile_template(f"\n{template}")
+        self.LLM_POST_TEMPLATE = compile_template(llm_template)
+        # 解析帖子时只留下两个模板用得到的顶层字段
+        self.post_fields = (
+            self.POST_TEMPLATE.root_keys | self.LLM_POST_TEMPLATE.root_keys
+        )
+
     def join_api(self, child: str, params: dict = {}):
         return merge_params(urljoin(self.BASE_URL, child), params)
 
     def get_user_constant_tags(self, group: str) -> list[str]:
-        return read_group_data(group)["constants"]
+        return read_group_value(group, "constants")
 
     def set_user_constant_tags(self, group: str, new_constants: list[str]):
-        return write_group_data(group, "constants", new_constants)
+        write_group_data(group, "constants", new_constants)
+
+    def get_user_blacklist(self, group: str) -> list[str]:
+        return read_group_value(group, "blacklist")
+
+    def set_user_blacklist(self, group: str, new_blacklist: list[str]):
+        write_group_data(group, "blacklist", new_blacklist)
 
     def get_current_rating(self, group: str):
-        return read_group_data(group)["rating"]
+        return read_group_value(group, "rating")
 
     def set_current_rating(self, group: str, new_rating: str):
-        return write_group_data(group, "rating", new_rating)
+        write_group_data(group, "rating", new_rating)
 
     async def terminate(self):
-        await self.client.aclose()
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        if self.mirror_task is not None:
+            self.mirror_task.cancel()
+        self.mirror.close()
+        if self.tag_task is not None:
+            self.tag_task.cancel()
+        self.tag_index.close()
+        if self.metrics_dump_task is not None:
+            self.metrics_dump_task.cancel()
+        self.random_pool.close()
+        # 群设置先落盘，快照只是缓存，写失败了也不能拖着设置和连接一起丢
+        try:
+            await close_group_data()
+            if self.CACHE_SNAPSHOT:
+                await self.save_snapshot()
+        finally:
+            await self.client.aclose()
@@ -0,0 +1,131 @@
+import bisect
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+
+# 0.1ms到约50s的对数分桶，每桶比上一桶宽25%，分位数误差不超过一个桶
+BUCKET_BOUNDS = [1e-4 * 1.25**i for i in range(60)]
+
+
+class Histogram:
+    """固定分桶的耗时直方图，记录一次只是一次二分查找加几个整数加法。"""
+
+    __slots__ = ("buckets", "count", "errors", "total")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float, error: bool = False):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+
+    def percentile(self, fraction: float) -> float:
+        if self.count == 0:
+            return 0.0
+        threshold = fraction * self.count
+        seen = 0
+        for index, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= threshold:
+                return BUCKET_BOUNDS[min(index, len(BUCKET_BOUNDS) - 1)]
+        return BUCKET_BOUNDS[-1]
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self.histograms: dict[str, Histogram] = {}
+        self.started = time.time()
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds, error)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, error)
+
+    def snapshot(self) -> dict:
+        return {
+            "since": self.started,
+            "metrics": {
+                name: histogram.summary()
+                for name, histogram in sorted(self.histograms.items())
+            },
+        }
+
+    def reset(self):
+        self.histograms.clear()
+        self.started = time.time()
+
+
+metrics = Metrics()
+
+
+def timed(name: str):
+    """给函数计时，支持普通函数、协程函数和异步生成器（命令处理器）。"""
+
+    def decorator(function):
+        if inspect.isasyncgenfunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with metrics.timer(name):
+                    async for item in function(*args, **kwargs):
+                        yield item
+
+        elif inspect.iscoroutinefunction(function):
+
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with metrics.timer(name):
+                    return await function(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with metrics.timer(name):
+                    return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def format_metrics(snapshot: dict) -> str:
+    lines = []
+    for name, summary in snapshot["metrics"].items():
+        lines.append(
+            f"{name}: n={summary['count']} err={summary['errors']} "
+            f"p50={summary['p50'] * 1000:.1f}ms "
+            f"p95={summary['p95'] * 1000:.1f}ms "
+            f"p99={summary['p99'] * 1000:.1f}ms"
+        )
+    return "\n".join(lines)
@@ -0,0 +1,614 @@
+import bisect
+import csv
+import gzip
+import heapq
+import json
+import mmap
+import os
+import random
+import shutil
+import sys
+import time
+from array import array
+
+from .constants import STATIC_URL
+from .models import Post
+
+# 索引目录里各列文件的类型码，全部按本机字节序存
+COLUMNS = {
+    "ids": "I",
+    "score": "i",
+    "up_score": "i",
+    "down_score": "i",
+    "fav_count": "I",
+    "comment_count": "I",
+    "file_size": "I",
+    "rating": "B",
+    "ext": "B",
+    "sample": "B",
+}
+TEXT_COLUMNS = ("description", "tag_string")
+# e621对长边超过850像素的图片生成sample
+SAMPLE_THRESHOLD = 850
+SAMPLE_EXTENSIONS = {"jpg", "png", "webp"}
+# 建索引时每列攒这么多个值写一次盘；倒排表每攒这么多条(标签, 帖子)就排序落盘一次
+WRITE_BLOCK = 1 << 16
+POSTING_CHUNK = 1 << 20
+# 单次查询最多逐条校验这么多候选，条件太稀疏时宁可交给在线API
+MAX_SCAN = 200_000
+
+
+def open_dump(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf8", newline="")
+    return open(path, "r", encoding="utf8", newline="")
+
+
+def find_latest_dump(path: str, prefix: str = "posts-") -> str | None:
+    """path可以是导出文件本身，也可以是放导出文件的目录（取文件名最大的<prefix>*.csv[.gz]）。"""
+    if os.path.isfile(path):
+        return path
+    if not os.path.isdir(path):
+        return None
+    dumps = sorted(
+        name
+        for name in os.listdir(path)
+        if name.startswith(prefix) and name.endswith((".csv", ".csv.gz"))
+    )
+    return os.path.join(path, dumps[-1]) if dumps else None
+
+
+def write_array(directory: str, name: str, values: array):
+    with open(os.path.join(directory, f"{name}.bin"), "wb") as file:
+        values.tofile(file)
+
+
+def write_text_column(directory: str, name: str, texts: list[bytes]):
+    offsets = array("Q", [0])
+    with open(os.path.join(directory, f"{name}.txt"), "wb") as file:
+        for text in texts:
+            file.write(text)
+            offsets.append(offsets[-1] + len(text))
+    write_array(directory, f"{name}.off", offsets)
+
+
+def current_version(directory: str) -> str | None:
+    """索引目录下正在用的那一版子目录，还没建过就返回None。"""
+    try:
+        with open(os.path.join(directory, "current"), encoding="utf8") as file:
+            name = file.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(directory, name) if name else None
+
+
+def new_version(directory: str) -> str:
+    version = os.path.join(directory, f"v{time.time_ns()}")
+    os.makedirs(version)
+    return version
+
+
+def publish_version(directory: str, version: str):
+    """把current指向新建好的一版，再删掉其他版本。
+
+    旧版本可能还映射着（Windows上打开的文件删不掉、也不能被替换），所以新版本放在新目录里，
+    只原子替换current这个小文件；删不掉的旧版本留到下次发布时再删。
+    """
+    temp_path = os.path.join(directory, "current.tmp")
+    with open(temp_path, "w", encoding="utf8") as file:
+        file.write(os.path.basename(version))
+    os.replace(temp_path, os.path.join(directory, "current"))
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name == "current" or path == version:
+            continue
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+class ColumnWriter:
+    """边读边写的定长列，攒满一块就追加到文件里，内存里只留一块。"""
+
+    def __init__(self, path: str, typecode: str):
+        self.file = open(path, "wb")
+        self.typecode = typecode
+        self.buffer = array(typecode)
+
+    def append(self, value):
+        self.buffer.append(value)
+        if len(self.buffer) >= WRITE_BLOCK:
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.file)
+        self.buffer = array(self.typecode)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TextColumnWriter:
+    """边读边写的文本列：内容直接追加到文件，内存里只留偏移量。"""
+
+    def __init__(self, directory: str, name: str):
+        self.file = open(os.path.join(directory, f"{name}.txt"), "wb")
+        self.offsets = ColumnWriter(os.path.join(directory, f"{name}.off.bin"), "Q")
+        self.offsets.append(0)
+        self.end = 0
+
+    def append(self, text: bytes):
+        self.file.write(text)
+        self.end += len(text)
+        self.offsets.append(self.end)
+
+    def close(self):
+        self.file.close()
+        self.offsets.close()
+
+
+def stage_dump(dump_path: str, directory: str) -> tuple[bool, dict[str, int]]:
+    """第一遍：按导出里的原始顺序把各列直接写到磁盘，返回(是否已按ID排好序, 扩展名表)。"""
+    csv.field_size_limit(sys.maxsize)
+    extensions: dict[str, int] = {}
+    columns = {
+        name: ColumnWriter(os.path.join(directory, f"{name}.bin"), typecode)
+        for name, typecode in COLUMNS.items()
+    }
+    md5 = ColumnWriter(os.path.join(directory, "md5.bin"), "B")
+    texts = {name: TextColumnWriter(directory, name) for name in TEXT_COLUMNS}
+    last_id = -1
+    ordered = True
+    with open_dump(dump_path) as file:
+        for row in csv.DictReader(file):
+            if row.get("is_deleted") == "t":
+                continue
+            id = int(row["id"])
+            ordered = ordered and id > last_id
+            last_id = id
+            extension = row["file_ext"]
+            width = int(row.get("image_width") or 0)
+            height = int(row.get("image_height") or 0)
+            values = (
+                id,
+                int(row.get("score") or 0),
+                int(row.get("up_score") or 0),
+                int(row.get("down_score") or 0),
+                int(row.get("fav_count") or 0),
+                int(row.get("comment_count") or 0),
+                int(row.get("file_size") or 0),
+                ord(row["rating"][0]),
+                extensions.setdefault(extension, len(extensions)),
+                int(
+                    extension in SAMPLE_EXTENSIONS
+                    and max(width, height) > SAMPLE_THRESHOLD
+                ),
+            )
+            for writer, value in zip(columns.values(), values):
+                writer.append(value)
+            md5.buffer.frombytes(
+                bytes.fromhex(row["md5"]) if len(row["md5"]) == 32 else bytes(16)
+            )
+            if len(md5.buffer) >= WRITE_BLOCK:
+                md5.flush()
+            texts["description"].append(row.get("description", "").encode("utf8"))
+            texts["tag_string"].append(row["tag_string"].encode("utf8"))
+    for writer in (*columns.values(), md5, *texts.values()):
+        writer.close()
+    return ordered, extensions
+
+
+def sort_staged(staging: str, directory: str):
+    """第二遍：导出不是按ID排好序的，就按ID顺序把每一列重排一遍写到目标目录。
+    行号顺序和倒排表一样用外部排序求出来，也落在临时目录里。"""
+    ids = MappedFile(os.path.join(staging, "ids.bin"), "I")
+    runs: list[str] = []
+    for start in range(0, len(ids.view), POSTING_CHUNK):
+        chunk = ids.view[start : start + POSTING_CHUNK]
+        runs.append(
+            write_run(
+                staging,
+                len(runs),
+                array("Q", (id << 32 | start + row for row, id in enumerate(chunk))),
+            )
+        )
+        chunk.release()
+    ids.close()
+    order = ColumnWriter(os.path.join(staging, "order.bin"), "I")
+    for pair in heapq.merge(*(read_run(path) for path in runs)):
+        order.append(pair & 0xFFFFFFFF)
+    order.close()
+    for path in runs:
+        os.remove(path)
+    mapped_order = MappedFile(os.path.join(staging, "order.bin"), "I")
+    order = mapped_order.view
+    for name, typecode in COLUMNS.items():
+        source = MappedFile(os.path.join(staging, f"{name}.bin"), typecode)
+        writer = ColumnWriter(os.path.join(directory, f"{name}.bin"), typecode)
+        for row in order:
+            writer.append(source.view[row])
+        writer.close()
+        source.close()
+    source = MappedFile(os.path.join(staging, "md5.bin"), "B")
+    with open(os.path.join(directory, "md5.bin"), "wb") as file:
+        for row in order:
+            file.write(source.view[row * 16 : row * 16 + 16])
+    source.close()
+    for name in TEXT_COLUMNS:
+        offsets = MappedFile(os.path.join(staging, f"{name}.off.bin"), "Q")
+        source = MappedFile(os.path.join(staging, f"{name}.txt"), "B")
+        writer = TextColumnWriter(directory, name)
+        for row in order:
+            writer.append(source.view[offsets.view[row] : offsets.view[row + 1]])
+        writer.close()
+        source.close()
+        offsets.close()
+    mapped_order.close()
+
+
+def write_run(directory: str, index: int, pairs: array) -> str:
+    path = os.path.join(directory, f"run{index}.bin")
+    with open(path, "wb") as file:
+        array("Q", sorted(pairs)).tofile(file)
+    return path
+
+
+def read_run(path: str):
+    with open(path, "rb") as file:
+        while True:
+            block = array("Q")
+            try:
+                block.fromfile(file, WRITE_BLOCK)
+            except EOFError:
+                # 最后一块不满，已读到的部分照样留在block里
+                pass
+            if not block:
+                return
+            yield from block
+
+
+def build_postings(directory: str, staging: str) -> dict[str, list[int]]:
+    """第三遍：外部排序建倒排表。(标签序号<<32 | 帖子ID)分块排序落盘，最后多路归并，
+    同一个标签的ID在归并结果里自然连续且有序。"""
+    offsets = MappedFile(os.path.join(directory, "tag_string.off.bin"), "Q")
+    texts = MappedFile(os.path.join(directory, "tag_string.txt"), "B")
+    ids = MappedFile(os.path.join(directory, "ids.bin"), "I")
+    vocabulary: dict[str, int] = {}
+    runs: list[str] = []
+    pairs = array("Q")
+    for row, id in enumerate(ids.view):
+        text = bytes(texts.view[offsets.view[row] : offsets.view[row + 1]])
+        for tag in text.decode("utf8").split():
+            pairs.append(vocabulary.setdefault(tag, len(vocabulary)) << 32 | id)
+        if len(pairs) >= POSTING_CHUNK:
+            runs.append(write_run(staging, len(runs), pairs))
+            pairs = array("Q")
+    if pairs:
+        runs.append(write_run(staging, len(runs), pairs))
+    del pairs
+    for mapped in (offsets, texts, ids):
+        mapped.close()
+
+    names = list(vocabulary)
+    del vocabulary
+    tags: dict[str, list[int]] = {}
+    writer = ColumnWriter(os.path.join(directory, "postings.bin"), "I")
+    offset = 0
+    current = -1
+    for pair in heapq.merge(*(read_run(path) for path in runs)):
+        tag = pair >> 32
+        if tag != current:
+            current = tag
+            tags[names[tag]] = [offset, 0]
+        writer.append(pair & 0xFFFFFFFF)
+        tags[names[tag]][1] += 1
+        offset += 1
+    writer.close()
+    return tags
+
+
+def build_index(dump_path: str, directory: str):
+    """把e621的posts导出（CSV）建成磁盘索引：按ID排好序的列存储，加上标签到ID数组的倒排表。
+
+    全程边读边写，内存占用和导出大小基本无关；建在新的版本目录里，建好再切换，建索引期间旧索引照常可用。
+    """
+    version = new_version(directory)
+    staging = os.path.join(version, "staging")
+    os.makedirs(staging)
+    ordered, extensions = stage_dump(dump_path, staging)
+    if ordered:
+        for name in os.listdir(staging):
+            os.replace(os.path.join(staging, name), os.path.join(version, name))
+    else:
+        sort_staged(staging, version)
+    tags = build_postings(version, staging)
+    shutil.rmtree(staging)
+    with open(os.path.join(version, "tags.json"), "w", encoding="utf8") as file:
+        json.dump(tags, file, ensure_ascii=False, separators=(",", ":"))
+    with open(os.path.join(version, "meta.json"), "w", encoding="utf8") as file:
+        json.dump(
+            {
+                "source": os.path.basename(dump_path),
+                "source_mtime": os.path.getmtime(dump_path),
+                "extensions": list(extensions),
+            },
+            file,
+        )
+    publish_version(directory, version)
+
+
+def read_meta(directory: str) -> dict | None:
+    try:
+        with open(os.path.join(directory, "meta.json"), encoding="utf8") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def needs_rebuild(dump_path: str, directory: str) -> bool:
+    version = current_version(directory)
+    meta = read_meta(version) if version else None
+    return (
+        meta is None
+        or meta["source"] != os.path.basename(dump_path)
+        or meta["source_mtime"] < os.path.getmtime(dump_path)
+    )
+
+
+class MappedFile:
+    """只读内存映射一个列文件，空文件没法mmap就退回空数组。"""
+
+    def __init__(self, path: str, typecode: str):
+        self.file = open(path, "rb")
+        if os.fstat(self.file.fileno()).st_size == 0:
+            self.map = None
+            self.base = memoryview(array(typecode))
+            self.view = self.base
+        else:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.base = memoryview(self.map)
+            self.view = self.base.cast(typecode)
+
+    def close(self):
+        try:
+            self.view.release()
+            self.base.release()
+            if self.map is not None:
+                self.map.close()
+        except BufferError:
+            # 还有查询拿着切片，交给垃圾回收去关
+            pass
+        self.file.close()
+
+
+class MirrorQuery:
+    __slots__ = ("positives", "negatives", "ratings", "excluded_ratings", "random")
+
+    def __init__(self):
+        self.positives: list[str] = []
+        self.negatives: list[str] = []
+        self.ratings: set[int] = set()
+        self.excluded_ratings: set[int] = set()
+        self.random = False
+
+
+def parse_query(tags: str) -> MirrorQuery | None:
+    """解析e621的标签串，遇到本地回答不了的语法（其他元标签、~、通配符）就返回None交给在线API。"""
+    query = MirrorQuery()
+    for tag in tags.split("+"):
+        if not tag:
+            continue
+        negated = tag.startswith("-")
+        name = tag[1:] if negated else tag
+        if not name or name.startswith("~") or "*" in name:
+            return None
+        if name.startswith("rating:"):
+            rating = name[len("rating:") :][:1]
+            if rating not in ("s", "q", "e"):
+                return None
+            (query.excluded_ratings if negated else query.ratings).add(ord(rating))
+        elif name == "order:random" and not negated:
+            query.random = True
+        elif ":" in name:
+            return None
+        else:
+            (query.negatives if negated else query.positives).append(name)
+    return query
+
+
+class LocalMirror:
+    """基于e621每日导出的本地镜像，用倒排索引回答标签交集、rating:和排除标签的查询。"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: dict[str, MappedFile] = {}
+        self.tags: dict[str, list[int]] = {}
+        self.extensions: list[str] = []
+        self.source = ""
+
+    @property
+    def loaded(self):
+        return bool(self.files)
+
+    def load(self):
+        version = current_version(self.directory)
+        meta = read_meta(version) if version else None
+        if meta is None:
+            return
+        files = {
+            name: MappedFile(os.path.join(version, f"{name}.bin"), typecode)
+            for name, typecode in COLUMNS.items()
+        }
+        files["md5"] = MappedFile(os.path.join(version, "md5.bin"), "B")
+        files["postings"] = MappedFile(os.path.join(version, "postings.bin"), "I")
+        for name in TEXT_COLUMNS:
+            files[f"{name}.off"] = MappedFile(
+                os.path.join(version, f"{name}.off.bin"), "Q"
+            )
+            files[name] = MappedFile(os.path.join(version, f"{name}.txt"), "B")
+        with open(os.path.join(version, "tags.json"), encoding="utf8") as file:
+            tags = json.load(file)
+        # 加载在后台线程里跑，旧的映射直接换掉，不在这里关，免得正在跑的查询读到一半
+        self.files = files
+        self.tags = tags
+        self.extensions = meta["extensions"]
+        self.source = meta["source"]
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        self.files = {}
+        self.tags = {}
+
+    @property
+    def count(self):
+        return len(self.files["ids"].view) if self.files else 0
+
+    def posting(self, tag: str) -> memoryview:
+        start, length = self.tags.get(tag, (0, 0))
+        return self.files["postings"].view[start : start + length]
+
+    @staticmethod
+    def contains(ids: memoryview, id: int) -> bool:
+        index = bisect.bisect_left(ids, id)
+        return index < len(ids) and ids[index] == id
+
+    def row_of(self, id: int) -> int | None:
+        ids = self.files["ids"].view
+        index = bisect.bisect_left(ids, id)
+        return index if index < len(ids) and ids[index] == id else None
+
+    def read_text(self, name: str, row: int) -> str:
+        offsets = self.files[f"{name}.off"].view
+        return bytes(self.files[name].view[offsets[row] : offsets[row + 1]]).decode(
+            "utf8"
+        )
+
+    def make_post(self, row: int, keys: frozenset[str]) -> Post:
+        files = self.files
+        id = files["ids"].view[row]
+        rating = chr(files["rating"].view[row])
+        md5 = bytes(files["md5"].view[row * 16 : row * 16 + 16]).hex()
+        extension = self.extensions[files["ext"].view[row]]
+        prefix = f"{md5[:2]}/{md5[2:4]}/{md5}"
+        tags = self.read_text("tag_string", row).split()
+        # 只算模板用得到的字段，描述这种大字段不用就不读
+        fields = {}
+        for key in keys:
+            if key == "id":
+                fields[key] = id
+            elif key == "rating":
+                fields[key] = rating
+            elif key == "score":
+                fields[key] = {
+                    "up": files["up_score"].view[row],
+                    "down": files["down_score"].view[row],
+                    "total": files["score"].view[row],
+                }
+            elif key in ("fav_count", "comment_count"):
+                fields[key] = files[key].view[row]
+            elif key == "description":
+                fields[key] = self.read_text("description", row)
+            elif key == "tags":
+                # 导出里的tag_string不分类别，全部算general，tags.artist这类占位符渲染为空
+                fields[key] = {"general": tags}
+            else:
+                # 导出里没有的字段（sources、relationships等）留个空值，模板里渲染为空
+                fields[key] = None
+        return Post(
+            id,
+            rating,
+            f"{STATIC_URL}/data/{prefix}.{extension}",
+            md5,
+            files["file_size"].view[row],
+            f"{STATIC_URL}/data/sample/{prefix}.jpg"
+            if files["sample"].view[row]
+            else None,
+            fields,
+            files["score"].view[row],
+            frozenset(tags),
+        )
+
+    def candidates(self, query: MirrorQuery) -> memoryview:
+        if not query.positives:
+            return self.files["ids"].view
+        # 从最短的倒排表出发，其他条件逐个校验
+        return min((self.posting(tag) for tag in query.positives), key=len)
+
+    def matches(self, query: MirrorQuery, id: int, row: int) -> bool:
+        rating = self.files["rating"].view[row]
+        if query.ratings and rating not in query.ratings:
+            return False
+        if rating in query.excluded_ratings:
+            return False
+        for tag in query.positives:
+            if not self.contains(self.posting(tag), id):
+                return False
+        for tag in query.negatives:
+            if self.contains(self.posting(tag), id):
+                return False
+        return True
+
+    def get(self, id: int, keys: frozenset[str]) -> Post | None:
+        if not self.loaded:
+            return None
+        row = self.row_of(id)
+        return self.make_post(row, keys) if row is not None else None
+
+    def search(
+        self, tags: str, limit: int, page: int | str, keys: frozenset[str]
+    ) -> list[Post] | None:
+        """按ID倒序分页，page可以是页码也可以是 b<id> 游标，和e621的语义一致。"""
+        query = parse_query(tags) if self.loaded else None
+        if query is None:
+            return None
+        if query.random:
+            return self.random(tags, limit, keys)
+        candidates = self.candidates(query)
+        if isinstance(page, str) and page.startswith("b"):
+            end = bisect.bisect_left(candidates, int(page[1:]))
+            skip = 0
+        else:
+            end = len(candidates)
+            skip = (int(page) - 1) * limit
+        posts = []
+        for index in range(end - 1, max(end - MAX_SCAN, 0) - 1, -1):
+            id = candidates[index]
+            row = self.row_of(id)
+            if row is None or not self.matches(query, id, row):
+                continue
+            if skip > 0:
+                skip -= 1
+                continue
+            posts.append(self.make_post(row, keys))
+            if len(posts) >= limit:
+                return posts
+        return posts if end <= MAX_SCAN else None
+
+    def random(self, tags: str, count: int, keys: frozenset[str]) -> list[Post] | None:
+        query = parse_query(tags) if self.loaded else None
+        if query is None:
+            return None
+        candidates = self.candidates(query)
+        rows: dict[int, None] = {}
+        # 先随机抽样碰运气，条件太苛刻抽不中的话再老老实实扫一遍
+        for _ in range(count * 32):
+            if not candidates or len(rows) >= count:
+                break
+            id = candidates[random.randrange(len(candidates))]
+            row = self.row_of(id)
+            if row is not None and self.matches(query, id, row):
+                rows[row] = None
+        if len(rows) < count and len(candidates) <= MAX_SCAN:
+            matched = [
+                row
+                for id in candidates
+                if (row := self.row_of(id)) is not None and self.matches(query, id, row)
+            ]
+            rows.update(dict.fromkeys(random.sample(matched, min(count, len(matched)))))
+        return [self.make_post(row, keys) for row in list(rows)[:count]]
@@ -0,0 +1,70 @@
+class Post:
+    """解析时就裁剪好的帖子：代码要用的字段放在槽里，模板用到的顶层键原样留在fields里，其余全部丢掉。"""
+
+    __slots__ = (
+        "id",
+        "rating",
+        "file_url",
+        "file_md5",
+        "file_size",
+        "sample_url",
+        "fields",
+        "score",
+        "tags",
+    )
+
+    def __init__(
+        self,
+        id: int,
+        rating: str,
+        file_url: str | None,
+        file_md5: str | None,
+        file_size: int,
+        sample_url: str | None,
+        fields: dict,
+        score: int = 0,
+        tags: frozenset[str] = frozenset(),
+    ):
+        self.id = id
+        self.rating = rating
+        self.file_url = file_url
+        self.file_md5 = file_md5
+        self.file_size = file_size
+        self.sample_url = sample_url
+        self.fields = fields
+        # 黑名单过滤要用到的分数和全部标签（不分类别）
+        self.score = score
+        self.tags = tags
+
+    @classmethod
+    def from_api(cls, data: dict, keys: frozenset[str]) -> "Post":
+        # 随机接口可能返回旧版的扁平结构（file_url、md5），posts.json是嵌套的file/sample
+        file: dict = data.get("file") or {}
+        sample: dict = data.get("sample") or {}
+        score = data.get("score", 0)
+        tags = data.get("tags") or {}
+        return cls(
+            data["id"],
+            data["rating"],
+            file.get("url") or data.get("file_url"),
+            file.get("md5") or data.get("md5"),
+            file.get("size") or data.get("file_size") or 0,
+            sample.get("url") if sample.get("has") else data.get("sample_url"),
+            {key: data[key] for key in keys if key in data},
+            score.get("total", 0) if isinstance(score, dict) else score,
+            frozenset(
+                tags.split()
+                if isinstance(tags, str)
+                else (tag for category in tags.values() for tag in category)
+            ),
+        )
+
+    # 模板渲染按字典的方式取值
+    def __contains__(self, key: str):
+        return key in self.fields
+
+    def __getitem__(self, key: str):
+        return self.fields[key]
+
+    def __repr__(self):
+        return f"Post(id={self.id}, rating={self.rating!r})"
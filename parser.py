@@ -1,13 +1,21 @@
 import re
 
+PLACEHOLDER_PATTERN = re.compile(r"\{([^{}]+)\}")
+
+# 访问链里的一步：(字典键, 列表下标)，键不是整数时下标为None
+Accessor = tuple[str, int | None]
+
 
 def render_template(template: str, data: dict) -> str:
     def replace_match(match: re.Match[str]):
         path_str = match.group(1)
         fallback_paths = path_str.split("|")
+        # 帖子有这个顶层字段只是取不到值（null、缺子键）就留空，连顶层字段都没有才原样输出
+        found = False
         for fallback_path in fallback_paths:
             fallback_path = fallback_path.strip()
             keys = fallback_path.split(".")
+            found = found or keys[0] in data
             current = data
             try:
                 for key in keys:
@@ -23,6 +31,96 @@ def render_template(template: str, data: dict) -> str:
                     return str(current)
             except (KeyError, IndexError, ValueError, TypeError):
                 continue
-        return match.group(0)
+        return "" if found else match.group(0)
+
+    return PLACEHOLDER_PATTERN.sub(replace_match, template)
+
+
+def compile_accessor(key: str) -> Accessor:
+    try:
+        return (key, int(key))
+    except ValueError:
+        return (key, None)
+
+
+class Placeholder:
+    __slots__ = ("raw", "chains")
+
+    def __init__(self, raw: str, chains: list[list[Accessor]]):
+        self.raw = raw
+        self.chains = chains
+
+    def resolve(self, data: dict, overrides: dict | None) -> str:
+        found = False
+        for chain in self.chains:
+            first_key = chain[0][0]
+            if overrides is not None and first_key in overrides:
+                current = overrides[first_key]
+            elif first_key in data:
+                current = data[first_key]
+            else:
+                continue
+            found = True
+            for key, index in chain[1:]:
+                if isinstance(current, dict) and key in current:
+                    current = current[key]
+                elif isinstance(current, list) and index is not None:
+                    try:
+                        current = current[index]
+                    except IndexError:
+                        break
+                else:
+                    break
+            else:
+                if current is not None:
+                    return str(current)
+        return "" if found else self.raw
+
+
+class CompiledTemplate:
+    """预编译好的模板：字面量片段和占位符按顺序排开，渲染时不再跑正则和切字符串。"""
+
+    __slots__ = ("source", "chunks")
+
+    def __init__(self, source: str, chunks: list[str | Placeholder]):
+        self.source = source
+        self.chunks = chunks
+
+    @property
+    def root_keys(self) -> frozenset[str]:
+        """模板里所有访问链的第一个键，解析帖子时只需要留下这些顶层字段。"""
+        return frozenset(
+            chain[0][0]
+            for chunk in self.chunks
+            if isinstance(chunk, Placeholder)
+            for chain in chunk.chains
+        )
+
+    def render(self, data: dict, overrides: dict | None = None) -> str:
+        return "".join(
+            [
+                chunk if isinstance(chunk, str) else chunk.resolve(data, overrides)
+                for chunk in self.chunks
+            ]
+        )
+
 
-    return re.compile(r"\{([^{}]+)\}").sub(replace_match, template)
+def compile_template(template: str) -> CompiledTemplate:
+    chunks: list[str | Placeholder] = []
+    position = 0
+    for match in PLACEHOLDER_PATTERN.finditer(template):
+        if match.start() > position:
+            chunks.append(template[position : match.start()])
+        chunks.append(
+            Placeholder(
+                match.group(0),
+                [
+                    [compile_accessor(key) for key in path.strip().split(".")]
+                    for path in match.group(1).split("|")
+                ],
+            )
+        )
+        position = match.end()
+    if position < len(template):
+        chunks.append(template[position:])
+    return CompiledTemplate(template, chunks)
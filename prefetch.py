@@ -0,0 +1,83 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable
+
+from .models import Post
+
+
+class RandomPostPool:
+    """按标签串预取随机帖子：一次请求拉一批，之后一条一条发出去，低于水位线就在后台补货。"""
+
+    def __init__(
+        self,
+        fetch_batch: Callable[[str], Awaitable[list[Post]]],
+        batch_size: int,
+        low_water: int,
+        idle_seconds: float,
+    ):
+        self.fetch_batch = fetch_batch
+        self.batch_size = batch_size
+        self.low_water = low_water
+        self.idle_seconds = idle_seconds
+        self.buffers: dict[str, deque[Post]] = {}
+        self.last_used: dict[str, float] = {}
+        self.refills: dict[str, asyncio.Task] = {}
+
+    @property
+    def enabled(self):
+        return self.batch_size > 0
+
+    async def take(
+        self, tags: str, accept: Callable[[Post], bool] = lambda post: True
+    ) -> Post | None:
+        self.evict_idle()
+        self.last_used[tags] = time.monotonic()
+        # 池子是空的只能当场等一批，请求失败的异常直接抛给调用方
+        while not self.buffers.get(tags):
+            await self.refill(tags)
+        buffer = self.buffers[tags]
+        # 不要的帖子直接扔掉，整池都不要就返回None，由调用方决定要不要再抽
+        post = None
+        while buffer:
+            candidate = buffer.popleft()
+            if accept(candidate):
+                post = candidate
+                break
+        if len(buffer) < self.low_water:
+            self.refill(tags)
+        return post
+
+    def refill(self, tags: str) -> asyncio.Task:
+        task = self.refills.get(tags)
+        if task is None or task.done():
+            task = asyncio.create_task(self.fill(tags))
+            task.add_done_callback(self.discard_refill_error)
+            self.refills[tags] = task
+        return task
+
+    async def fill(self, tags: str):
+        posts = await self.fetch_batch(tags)
+        self.buffers.setdefault(tags, deque()).extend(posts)
+
+    @staticmethod
+    def discard_refill_error(task: asyncio.Task):
+        # 后台补货失败不要紧，下次取的时候再补
+        if not task.cancelled():
+            task.exception()
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        for tags in [t for t, used in self.last_used.items() if used < deadline]:
+            del self.last_used[tags]
+            self.buffers.pop(tags, None)
+            task = self.refills.pop(tags, None)
+            if task is not None:
+                task.cancel()
+
+    def close(self):
+        for task in self.refills.values():
+            task.cancel()
+        self.refills.clear()
+        self.buffers.clear()
+        self.last_used.clear()
@@ -0,0 +1,80 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Generic, TypeVar
+
+import httpx
+
+T = TypeVar("T")
+
+# 这些状态码说明是被限流或者服务端暂时扛不住，退避一下还能重试
+RETRY_STATUS_CODES = (429, 503)
+
+
+class TokenBucket:
+    """令牌桶限速，rate为每秒补充的令牌数，填0或负数就不限速。"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        # 排队拿令牌，先到先得
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class SingleFlight(Generic[T]):
+    """同一个键同时只发一次请求，并发进来的调用共享结果。"""
+
+    def __init__(self):
+        self.flights: dict[str, asyncio.Future[T]] = {}
+
+    async def do(self, key: str, factory: Callable[[], Awaitable[T]]) -> T:
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(factory())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+        # shield：某个等待者被取消时不连累其他共享这次请求的人
+        return await asyncio.shield(flight)
+
+
+def parse_retry_after(response: httpx.Response) -> float | None:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(
+    attempt: int, base: float, max_delay: float, response: httpx.Response
+) -> float | None:
+    """返回下次重试前要等的秒数；服务端要求等得比max_delay还久就返回None，不重试了。"""
+    retry_after = parse_retry_after(response)
+    if retry_after is not None:
+        return retry_after if retry_after <= max_delay else None
+    # full jitter指数退避，避免几个群的请求同时醒来又撞一起
+    return min(random.uniform(0, base * 2**attempt), max_delay)
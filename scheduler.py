@@ -0,0 +1,137 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Hashable
+
+from .metrics import metrics
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+class Superseded(Exception):
+    pass
+
+
+class Waiter:
+    __slots__ = ("group", "key", "future")
+
+    def __init__(self, group: str, key: Hashable | None):
+        self.group = group
+        self.key = key
+        self.future: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+
+class FairScheduler:
+    """按群轮转放行请求：全局和每个群都有并发上限，排队数有上限，排满直接拒绝。"""
+
+    def __init__(
+        self, max_running: int, group_running: int, max_queued: int, group_queued: int
+    ):
+        self.max_running = max_running
+        self.group_running_limit = group_running
+        self.max_queued = max_queued
+        self.group_queued = group_queued
+        self.running = 0
+        self.group_running: dict[str, int] = {}
+        self.queues: dict[str, deque[Waiter]] = {}
+        self.queued = 0
+        # 有请求在排队的群，按轮转顺序排
+        self.turns: deque[str] = deque()
+
+    @property
+    def enabled(self):
+        return self.max_running > 0
+
+    @asynccontextmanager
+    async def slot(self, group: str, key: Hashable | None = None):
+        """排队等到名额再执行；同一个key的新请求会顶掉还没开始的旧请求。"""
+        if not self.enabled:
+            yield
+            return
+        waiter = self.enqueue(group, key)
+        self.dispatch()
+        try:
+            with metrics.timer("scheduler.wait"):
+                await waiter.future
+        except asyncio.CancelledError:
+            # 被取消时可能刚好已经放行了，名额要还回去
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(group)
+            else:
+                self.discard(waiter)
+            raise
+        try:
+            yield
+        finally:
+            self.release(group)
+
+    def enqueue(self, group: str, key: Hashable | None) -> Waiter:
+        queue = self.queues.setdefault(group, deque())
+        if key is not None:
+            for stale in [waiter for waiter in queue if waiter.key == key]:
+                queue.remove(stale)
+                self.queued -= 1
+                stale.future.set_exception(
+                    Superseded("收到了一条相同的新指令，这条就不执行了。")
+                )
+        if self.queued >= self.max_queued or len(queue) >= self.group_queued:
+            if not queue:
+                self.forget(group)
+            raise SchedulerBusy("当前请求太多，请稍后再试。")
+        waiter = Waiter(group, key)
+        queue.append(waiter)
+        self.queued += 1
+        if group not in self.turns:
+            self.turns.append(group)
+        return waiter
+
+    def dispatch(self):
+        # 轮到的群名额用满了就跳过，排到队尾等下一轮
+        skipped = 0
+        while self.running < self.max_running and skipped < len(self.turns):
+            group = self.turns.popleft()
+            queue = self.queues.get(group)
+            if not queue:
+                self.queues.pop(group, None)
+                continue
+            if self.group_running.get(group, 0) >= self.group_running_limit:
+                self.turns.append(group)
+                skipped += 1
+                continue
+            waiter = queue.popleft()
+            self.queued -= 1
+            if queue:
+                self.turns.append(group)
+            else:
+                del self.queues[group]
+            if waiter.future.done():
+                continue
+            self.running += 1
+            self.group_running[group] = self.group_running.get(group, 0) + 1
+            waiter.future.set_result(None)
+            skipped = 0
+
+    def release(self, group: str):
+        self.running -= 1
+        count = self.group_running[group] - 1
+        if count:
+            self.group_running[group] = count
+        else:
+            del self.group_running[group]
+        self.dispatch()
+
+    def discard(self, waiter: Waiter):
+        queue = self.queues.get(waiter.group)
+        if queue is None or waiter not in queue:
+            return
+        queue.remove(waiter)
+        self.queued -= 1
+        if not queue:
+            self.forget(waiter.group)
+
+    def forget(self, group: str):
+        self.queues.pop(group, None)
+        if group in self.turns:
+            self.turns.remove(group)
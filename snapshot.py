@@ -0,0 +1,168 @@
+import bisect
+import json
+import marshal
+import os
+import shutil
+import sys
+import time
+from array import array
+
+from .mirror import MappedFile, write_array, write_text_column
+from .models import Post
+
+# 格式变了就改版本号，旧快照直接作废
+SNAPSHOT_VERSION = 2
+
+# (过期的墙上时间, 值)，进程重启后monotonic时钟不连续，落盘只能用墙上时间
+Page = tuple[float, list[Post]]
+Cursor = tuple[float, int]
+
+
+def dump_post(post: Post) -> bytes:
+    return marshal.dumps(
+        (
+            post.id,
+            post.rating,
+            post.file_url,
+            post.file_md5,
+            post.file_size,
+            post.sample_url,
+            post.fields,
+            post.score,
+            post.tags,
+        )
+    )
+
+
+def load_post(data: bytes) -> Post:
+    return Post(*marshal.loads(data))
+
+
+def write_snapshot(
+    directory: str,
+    pages: dict[str, Page],
+    cursors: dict[str, Cursor],
+    fingerprint: dict,
+):
+    """帖子按ID去重排好序存成列（查的时候二分），页面和游标只记帖子ID。"""
+    posts: dict[int, Post] = {}
+    for _, page in pages.values():
+        for post in page:
+            posts[post.id] = post
+    ids = sorted(posts)
+    temp_directory = f"{directory}.writing"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    write_array(temp_directory, "ids", array("I", ids))
+    write_text_column(temp_directory, "posts", [dump_post(posts[id]) for id in ids])
+    with open(os.path.join(temp_directory, "pages.bin"), "wb") as file:
+        marshal.dump(
+            {
+                "pages": {
+                    key: (expires, [post.id for post in page])
+                    for key, (expires, page) in pages.items()
+                },
+                "cursors": cursors,
+            },
+            file,
+        )
+    with open(os.path.join(temp_directory, "meta.json"), "w", encoding="utf8") as file:
+        json.dump(
+            {
+                "version": SNAPSHOT_VERSION,
+                # marshal的格式跟着Python版本走
+                "python": list(sys.version_info[:2]),
+                "created": time.time(),
+                "fingerprint": fingerprint,
+            },
+            file,
+        )
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(temp_directory, directory)
+
+
+class Snapshot:
+    """上次退出时留下的缓存快照：页面表很小，启动时读进来；帖子留在mmap里，用到哪条才解码哪条。"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.ids: MappedFile | None = None
+        self.offsets: MappedFile | None = None
+        self.posts: MappedFile | None = None
+        self.pages: dict[str, tuple[float, list[int]]] = {}
+        self.cursors: dict[str, Cursor] = {}
+
+    @property
+    def loaded(self):
+        return self.ids is not None
+
+    def load(self, fingerprint: dict) -> bool:
+        """快照版本、Python版本或配置指纹对不上就当没有。"""
+        try:
+            with open(
+                os.path.join(self.directory, "meta.json"), encoding="utf8"
+            ) as file:
+                meta = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+        if (
+            meta.get("version") != SNAPSHOT_VERSION
+            or meta.get("python") != list(sys.version_info[:2])
+            or meta.get("fingerprint") != fingerprint
+        ):
+            return False
+        try:
+            with open(os.path.join(self.directory, "pages.bin"), "rb") as file:
+                tables = marshal.load(file)
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        now = time.time()
+        self.pages = {
+            key: page for key, page in tables["pages"].items() if page[0] > now
+        }
+        self.cursors = {
+            key: cursor for key, cursor in tables["cursors"].items() if cursor[0] > now
+        }
+        self.ids = MappedFile(os.path.join(self.directory, "ids.bin"), "I")
+        self.offsets = MappedFile(os.path.join(self.directory, "posts.off.bin"), "Q")
+        self.posts = MappedFile(os.path.join(self.directory, "posts.txt"), "B")
+        return True
+
+    def post(self, id: int) -> Post | None:
+        if self.ids is None:
+            return None
+        ids = self.ids.view
+        row = bisect.bisect_left(ids, id)
+        if row == len(ids) or ids[row] != id:
+            return None
+        offsets = self.offsets.view
+        return load_post(bytes(self.posts.view[offsets[row] : offsets[row + 1]]))
+
+    def take_page(self, key: str) -> tuple[list[Post], float] | None:
+        """取出一页并从表里删掉，返回(帖子, 剩余秒数)；过期或者缺帖子就返回None。"""
+        page = self.pages.pop(key, None)
+        if page is None:
+            return None
+        expires, ids = page
+        ttl = expires - time.time()
+        posts = [self.post(id) for id in ids]
+        if ttl <= 0 or None in posts:
+            return None
+        return posts, ttl
+
+    def remaining_pages(self) -> dict[str, Page]:
+        pages: dict[str, Page] = {}
+        for key in list(self.pages):
+            expires = self.pages[key][0]
+            restored = self.take_page(key)
+            if restored is not None:
+                pages[key] = (expires, restored[0])
+        return pages
+
+    def close(self):
+        for mapped in (self.ids, self.offsets, self.posts):
+            if mapped is not None:
+                mapped.close()
+        self.ids = self.offsets = self.posts = None
+        self.pages = {}
+        self.cursors = {}
@@ -0,0 +1,293 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from astrbot.api import logger
+
+from .constants import INITIAL_GROUP_DATA, get_plugin_data_path
+
+Change = tuple[str, str, object]
+
+
+def get_group_data_path(group: str):
+    return get_plugin_data_path() / f"{group}.json"
+
+
+def get_group_of_path(path) -> str:
+    # 私聊的群号是空字符串，文件名就是".json"，不能用Path.stem
+    return path.name[: -len(".json")]
+
+
+def list_group_files():
+    return sorted(get_plugin_data_path().glob("*.json"))
+
+
+def with_defaults(stored: dict | None) -> dict:
+    # 老数据可能缺键，统一用默认值兜底
+    return copy.deepcopy(INITIAL_GROUP_DATA) | (stored or {})
+
+
+def read_json_file(path) -> dict:
+    with open(path, "r", encoding="utf8") as file:
+        return json.load(file)
+
+
+def read_group_file(path) -> dict | None:
+    """读一个群的JSON文件，文件坏了就改名挪开并返回None，一个坏文件不能拦住启动。"""
+    try:
+        data = read_json_file(path)
+        if isinstance(data, dict):
+            return data
+    except FileNotFoundError:
+        return None
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        pass
+    logger.warning(f"群设置文件 {path} 已损坏，已改名为 {path}.corrupt 并跳过。")
+    os.replace(path, f"{path}.corrupt")
+    return None
+
+
+def write_json_file_atomic(path, data: dict):
+    # 先写临时文件再原子替换，进程中途挂掉也不会留下半截文件
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf8") as file:
+        json.dump(data, file, ensure_ascii=False)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+
+
+class GroupStore(ABC):
+    """群设置存储后端，所有方法都只会在存储线程里被调用。"""
+
+    @abstractmethod
+    def load(self, group: str) -> dict | None: ...
+
+    @abstractmethod
+    def load_all(self) -> dict[str, dict]: ...
+
+    @abstractmethod
+    def save(self, changes: list[Change]): ...
+
+    def close(self):
+        pass
+
+
+class JsonGroupStore(GroupStore):
+    """一个群一个JSON文件，兼容旧版本的存储方式。"""
+
+    def load(self, group: str) -> dict | None:
+        return read_group_file(get_group_data_path(group))
+
+    def load_all(self) -> dict[str, dict]:
+        result: dict[str, dict] = {}
+        for path in list_group_files():
+            data = read_group_file(path)
+            if data is not None:
+                result[get_group_of_path(path)] = data
+        return result
+
+    def save(self, changes: list[Change]):
+        groups: dict[str, dict] = {}
+        for group, key, value in changes:
+            if group not in groups:
+                groups[group] = self.load(group) or {}
+            groups[group][key] = value
+        for group, data in groups.items():
+            write_json_file_atomic(get_group_data_path(group), data)
+
+
+class SqliteGroupStore(GroupStore):
+    """所有群放在同一个WAL模式的SQLite库里，按(群, 键)单独更新。"""
+
+    def __init__(self, path=None):
+        # 不传路径就等第一次连接时再取数据目录，导入模块时不碰文件系统
+        self.path = path
+        self._connection: sqlite3.Connection | None = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            if self.path is None:
+                self.path = get_plugin_data_path() / "group_data.db"
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS group_data ("
+                "group_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (group_id, key))"
+            )
+            self.migrate_json_files()
+        return self._connection
+
+    def migrate_json_files(self):
+        # 把旧版的 <group>.json 逐个导进来，导完一个改名一个；
+        # 已有的键不覆盖，中途挂掉重来也不会冲掉迁移后改过的设置
+        for path in list_group_files():
+            data = read_group_file(path)
+            if data is None:
+                continue
+            group = get_group_of_path(path)
+            with self._connection:
+                self._connection.executemany(
+                    "INSERT INTO group_data (group_id, key, value) VALUES (?, ?, ?) "
+                    "ON CONFLICT (group_id, key) DO NOTHING",
+                    [
+                        (group, key, json.dumps(value, ensure_ascii=False))
+                        for key, value in data.items()
+                    ],
+                )
+            os.replace(path, f"{path}.migrated")
+
+    def load(self, group: str) -> dict | None:
+        rows = self.connection.execute(
+            "SELECT key, value FROM group_data WHERE group_id = ?", (group,)
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows} if rows else None
+
+    def load_all(self) -> dict[str, dict]:
+        result: dict[str, dict] = {}
+        for group, key, value in self.connection.execute(
+            "SELECT group_id, key, value FROM group_data"
+        ):
+            result.setdefault(group, {})[key] = json.loads(value)
+        return result
+
+    def save(self, changes: list[Change]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO group_data (group_id, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (group_id, key) DO UPDATE SET value = excluded.value",
+                [
+                    (group, key, json.dumps(value, ensure_ascii=False))
+                    for group, key, value in changes
+                ],
+            )
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+STORE_BACKENDS: dict[str, type[GroupStore]] = {
+    "sqlite": SqliteGroupStore,
+    "json": JsonGroupStore,
+}
+
+
+class GroupDataCache:
+    """群设置的进程内缓存：读直接走内存，写先落内存，再由后台任务合并刷盘。"""
+
+    def __init__(self, store: GroupStore | None = None, flush_delay: float = 1.0):
+        self.store = store or SqliteGroupStore()
+        self.flush_delay = flush_delay
+        self.entries: dict[str, dict] = {}
+        # 预加载完成后没在entries里的群就是没存过设置的，直接用默认值，不用再去读盘
+        self.preloaded = False
+        # 按(群, 键)记脏，刷盘时只更新改过的键
+        self.dirty: dict[tuple[str, str], None] = {}
+        self.flush_task: asyncio.Task | None = None
+        # 单线程执行器：存储操作全在这一个线程里按提交顺序执行
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="e621-storage"
+        )
+
+    def use_store(self, store: GroupStore):
+        self.executor.submit(self.store.close).result()
+        self.store = store
+        self.entries.clear()
+        self.preloaded = False
+
+    def get(self, group: str) -> dict:
+        # 预加载没赶上的话，每个群也只在第一次访问时读一次盘
+        if group not in self.entries:
+            stored = (
+                None
+                if self.preloaded
+                else self.executor.submit(self.store.load, group).result()
+            )
+            self.entries[group] = with_defaults(stored)
+        return self.entries[group]
+
+    def set(self, group: str, key: str, value: object) -> dict:
+        data = self.get(group)
+        data[key] = value
+        self.dirty[(group, key)] = None
+        self.schedule_flush()
+        return data
+
+    async def preload(self):
+        stored = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.store.load_all
+        )
+        for group, data in stored.items():
+            self.entries.setdefault(group, with_defaults(data))
+        self.preloaded = True
+
+    def take_dirty(self) -> list[Change]:
+        changes = [
+            (group, key, copy.deepcopy(self.entries[group][key]))
+            for group, key in self.dirty
+        ]
+        self.dirty.clear()
+        return changes
+
+    def restore_dirty(self, changes: list[Change]):
+        # 写盘失败的键重新记脏，值以内存里的为准（写盘期间又改过也没关系），下次刷盘再写
+        logger.exception(f"群设置写盘失败，{len(changes)}项修改留到下次刷盘重试")
+        for group, key, _ in changes:
+            if group in self.entries:
+                self.dirty[(group, key)] = None
+
+    def schedule_flush(self):
+        if self.flush_task and not self.flush_task.done():
+            # 已经有刷盘任务在等了，这次写入会被它一起带走
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环里（比如脚本直接调用），那就同步写掉
+            changes = self.take_dirty()
+            try:
+                self.executor.submit(self.store.save, changes).result()
+            except Exception:
+                self.restore_dirty(changes)
+                raise
+            return
+        self.flush_task = loop.create_task(self.delayed_flush())
+
+    async def delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await self.flush()
+        except Exception:
+            # 已经记过日志、键也放回去了，后台任务里没人接这个异常
+            pass
+
+    async def flush(self):
+        loop = asyncio.get_running_loop()
+        # 取快照和提交之间没有await，执行器按FIFO执行，新快照一定后落盘
+        while self.dirty:
+            changes = self.take_dirty()
+            try:
+                await loop.run_in_executor(self.executor, self.store.save, changes)
+            except Exception:
+                self.restore_dirty(changes)
+                raise
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.store.close
+            )
+
+
+group_data_cache = GroupDataCache()
@@ -0,0 +1,65 @@
+import codecs
+import json
+import re
+from json import JSONDecodeError
+from typing import AsyncIterator
+
+POSTS_ARRAY_PATTERN = re.compile(r'\s*\{\s*"posts"\s*:\s*\[')
+# 判断响应开头是不是 {"posts":[ 之前至少要攒这么多字符
+POSTS_PREFIX_LENGTH = 32
+DECODER = json.JSONDecoder()
+
+
+def skip_separators(buffer: str, position: int) -> int:
+    while position < len(buffer) and buffer[position] in " \t\r\n,":
+        position += 1
+    return position
+
+
+async def read_posts(chunks: AsyncIterator[bytes], limit: int | None) -> dict | list:
+    """边收边解析 {"posts":[...]} 响应，一次只解析数组里的一个元素，攒够limit个就不再读了。
+
+    响应不是这个形状时（比如按ID查帖子、报错）就读完整个响应按普通JSON解析。
+    """
+    decoder = codecs.getincrementaldecoder("utf8")()
+    buffer = ""
+    position = 0
+    in_array = False
+    posts: list = []
+    finished = False
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        if not in_array:
+            match = POSTS_ARRAY_PATTERN.match(buffer)
+            if match is None:
+                if len(buffer) < POSTS_PREFIX_LENGTH:
+                    continue
+                break
+            in_array = True
+            position = match.end()
+        while True:
+            position = skip_separators(buffer, position)
+            if position >= len(buffer):
+                break
+            if buffer[position] == "]":
+                finished = True
+                break
+            try:
+                post, position = DECODER.raw_decode(buffer, position)
+            except JSONDecodeError:
+                # 这个元素还没收完整，等下一块数据
+                break
+            posts.append(post)
+            if limit is not None and len(posts) >= limit:
+                finished = True
+                break
+        if finished:
+            return posts
+        # 解析过的部分直接丢掉，内存占用只和单个帖子的大小有关
+        buffer = buffer[position:]
+        position = 0
+    if in_array:
+        raise JSONDecodeError("Unterminated posts array", buffer, position)
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+    return json.loads(buffer + decoder.decode(b"", final=True))
@@ -0,0 +1,285 @@
+import bisect
+import csv
+import difflib
+import heapq
+import json
+import os
+import sys
+from array import array
+
+from .mirror import (
+    MappedFile,
+    current_version,
+    new_version,
+    open_dump,
+    publish_version,
+    write_array,
+    write_text_column,
+)
+
+# 纠错时每个前缀取这么多个最热门的标签当候选，再加上排序位置附近的
+SUGGESTION_POOL = 30
+SUGGESTION_NEIGHBOURS = 20
+# 和输入越像分越高，低于这个分数的不拿来当建议
+SUGGESTION_CUTOFF = 0.75
+# 比所有标签名里的字符都大，拼在前缀后面二分就能找到前缀区间的结尾
+PREFIX_END = "\U0010ffff"
+
+
+def build_count_tree(counts: array) -> array:
+    """帖子数的区间最大值线段树（存下标），自底向上，叶子在后半段。"""
+    size = len(counts)
+    tree = array("I", [0] * size) + array("I", range(size))
+    for node in range(size - 1, 0, -1):
+        left, right = tree[2 * node], tree[2 * node + 1]
+        tree[node] = left if counts[left] >= counts[right] else right
+    return tree
+
+
+def build_tag_index(tags_path: str, aliases_path: str | None, directory: str):
+    """把e621的tags和tag_aliases导出建成按名字排好序的磁盘索引，没有帖子的标签直接丢掉。"""
+    csv.field_size_limit(sys.maxsize)
+    counts: dict[str, int] = {}
+    with open_dump(tags_path) as file:
+        for row in csv.DictReader(file):
+            count = int(row.get("post_count") or 0)
+            if count > 0:
+                counts[row["name"]] = count
+    names = sorted(counts)
+    positions = {name: index for index, name in enumerate(names)}
+    aliases: dict[str, int] = {}
+    if aliases_path:
+        with open_dump(aliases_path) as file:
+            for row in csv.DictReader(file):
+                target = positions.get(row["consequent_name"])
+                if row.get("status") == "active" and target is not None:
+                    aliases[row["antecedent_name"]] = target
+
+    # 和本地镜像一样建在新的版本目录里再切换，旧版本还映射着也不影响
+    version = new_version(directory)
+    write_text_column(version, "names", [name.encode("utf8") for name in names])
+    count_column = array("I", [counts[name] for name in names])
+    write_array(version, "counts", count_column)
+    write_array(version, "count_tree", build_count_tree(count_column))
+    alias_names = sorted(aliases)
+    write_text_column(version, "aliases", [name.encode("utf8") for name in alias_names])
+    write_array(
+        version,
+        "alias_targets",
+        array("I", [aliases[name] for name in alias_names]),
+    )
+    with open(os.path.join(version, "meta.json"), "w", encoding="utf8") as file:
+        json.dump(
+            {
+                "sources": [
+                    [os.path.basename(path), os.path.getmtime(path)]
+                    for path in (tags_path, aliases_path)
+                    if path
+                ]
+            },
+            file,
+        )
+    publish_version(directory, version)
+
+
+def needs_tag_rebuild(tags_path: str, aliases_path: str | None, directory: str) -> bool:
+    version = current_version(directory)
+    if version is None:
+        return True
+    try:
+        with open(os.path.join(version, "meta.json"), encoding="utf8") as file:
+            sources = json.load(file)["sources"]
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return True
+    return sources != [
+        [os.path.basename(path), os.path.getmtime(path)]
+        for path in (tags_path, aliases_path)
+        if path
+    ]
+
+
+class SortedNames:
+    """内存映射的一列排好序的字符串，支持下标访问，可以直接拿bisect二分。"""
+
+    def __init__(self, directory: str, name: str):
+        self.text = MappedFile(os.path.join(directory, f"{name}.txt"), "B")
+        self.offsets = MappedFile(os.path.join(directory, f"{name}.off.bin"), "Q")
+
+    def __len__(self):
+        return max(len(self.offsets.view) - 1, 0)
+
+    def __getitem__(self, index: int) -> str:
+        offsets = self.offsets.view
+        return bytes(self.text.view[offsets[index] : offsets[index + 1]]).decode("utf8")
+
+    def find(self, name: str) -> int | None:
+        index = bisect.bisect_left(self, name)
+        return index if index < len(self) and self[index] == name else None
+
+    def prefixed(self, prefix: str) -> range:
+        start = bisect.bisect_left(self, prefix)
+        return range(start, bisect.bisect_left(self, prefix + PREFIX_END, start))
+
+    def around(self, name: str, radius: int) -> range:
+        index = bisect.bisect_left(self, name)
+        return range(max(index - radius, 0), min(index + radius, len(self)))
+
+    def close(self):
+        self.text.close()
+        self.offsets.close()
+
+
+class TagIndex:
+    """本地标签词典：别名换成正式标签、补全前缀、给不存在的标签找相近的写法。"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.names: SortedNames | None = None
+        self.counts: MappedFile | None = None
+        self.count_tree: MappedFile | None = None
+        self.aliases: SortedNames | None = None
+        self.alias_targets: MappedFile | None = None
+
+    @property
+    def loaded(self):
+        return self.names is not None
+
+    @property
+    def count(self):
+        return len(self.names) if self.names is not None else 0
+
+    def load(self):
+        version = current_version(self.directory)
+        if version is None or not os.path.exists(os.path.join(version, "meta.json")):
+            return
+        names = SortedNames(version, "names")
+        counts = MappedFile(os.path.join(version, "counts.bin"), "I")
+        count_tree = MappedFile(os.path.join(version, "count_tree.bin"), "I")
+        aliases = SortedNames(version, "aliases")
+        alias_targets = MappedFile(os.path.join(version, "alias_targets.bin"), "I")
+        # 和本地镜像一样整体替换，旧的映射交给垃圾回收
+        self.names, self.counts, self.count_tree = names, counts, count_tree
+        self.aliases, self.alias_targets = aliases, alias_targets
+
+    def close(self):
+        for mapped in (
+            self.names,
+            self.counts,
+            self.count_tree,
+            self.aliases,
+            self.alias_targets,
+        ):
+            if mapped is not None:
+                mapped.close()
+        self.names = self.counts = self.count_tree = None
+        self.aliases = self.alias_targets = None
+
+    def resolve(self, name: str) -> str:
+        if self.aliases is None or self.names is None:
+            return name
+        index = self.aliases.find(name)
+        if index is None:
+            return name
+        return self.names[self.alias_targets.view[index]]
+
+    def canonical(self, tag: str) -> str:
+        """别名换成正式标签，保留前面的-和~，元标签和通配符原样返回。"""
+        prefix = tag[:1] if tag[:1] in ("-", "~") else ""
+        name = tag[len(prefix) :].lower()
+        if not self.loaded or not name or ":" in name or "*" in name:
+            return tag
+        return prefix + self.resolve(name)
+
+    def exists(self, name: str) -> bool:
+        return self.names is not None and self.names.find(name) is not None
+
+    def unknown(self, tags: str) -> list[str]:
+        """找出查询里本地词典没有的正向标签，这些标签请求了也只会搜不到。"""
+        if not self.loaded:
+            return []
+        return [
+            tag
+            for tag in tags.split("+")
+            if tag
+            and not tag.startswith(("-", "~"))
+            and ":" not in tag
+            and "*" not in tag
+            and not self.exists(tag.lower())
+        ]
+
+    def range_max(self, start: int, end: int) -> int:
+        """[start, end)里帖子数最多的标签下标，线段树上走O(log n)步。"""
+        tree, counts = self.count_tree.view, self.counts.view
+        size = len(counts)
+        best = start
+        start += size
+        end += size
+        while start < end:
+            if start & 1:
+                if counts[tree[start]] > counts[best]:
+                    best = tree[start]
+                start += 1
+            if end & 1:
+                end -= 1
+                if counts[tree[end]] > counts[best]:
+                    best = tree[end]
+            start >>= 1
+            end >>= 1
+        return best
+
+    def most_popular(self, found: range, limit: int) -> list[int]:
+        # 每次取出区间最大值，再把区间从这里劈成两半放回堆里，取前limit个只要O(limit·log n)
+        counts = self.counts.view
+        heap: list[tuple[int, int, int, int]] = []
+
+        def push(start: int, end: int):
+            if start < end:
+                best = self.range_max(start, end)
+                heapq.heappush(heap, (-counts[best], best, start, end))
+
+        push(found.start, found.stop)
+        result = []
+        while heap and len(result) < limit:
+            _, best, start, end = heapq.heappop(heap)
+            result.append(best)
+            push(start, best)
+            push(best + 1, end)
+        return result
+
+    def complete(self, prefix: str, limit: int) -> list[tuple[str, int]]:
+        """按帖子数从多到少返回以prefix开头的标签。"""
+        if self.names is None:
+            return []
+        counts = self.counts.view
+        found = self.names.prefixed(prefix.lower())
+        return [
+            (self.names[index], counts[index])
+            for index in self.most_popular(found, limit)
+        ]
+
+    def suggest(self, name: str, limit: int) -> list[str]:
+        if self.names is None or not name:
+            return []
+        name = name.lower()
+        # 打错的一般是热门标签：候选取几个前缀（包括前两个字母对调）里最热门的，
+        # 再加上排序位置附近的，打错中间和结尾的字都能找回来
+        prefixes = {name[:1], name[:2], name[:3], name[1:2] + name[:1]}
+        candidates = {
+            self.names[index]
+            for prefix in prefixes
+            for index in self.most_popular(self.names.prefixed(prefix), SUGGESTION_POOL)
+        }
+        candidates.update(
+            self.names[index]
+            for index in self.names.around(name, SUGGESTION_NEIGHBOURS)
+        )
+        if self.aliases is not None:
+            candidates.update(
+                self.aliases[index]
+                for index in self.aliases.around(name, SUGGESTION_NEIGHBOURS)
+            )
+        matches = difflib.get_close_matches(
+            name, candidates, limit * 2, SUGGESTION_CUTOFF
+        )
+        # 别名换成正式标签，去重后保持相似度顺序
+        return list(dict.fromkeys(self.resolve(match) for match in matches))[:limit]
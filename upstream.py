@@ -0,0 +1,126 @@
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+from .metrics import Histogram
+
+# 连续失败几次算挂了，挂了之后多久再试
+FAILURE_THRESHOLD = 3
+COOLDOWN_SECONDS = 30
+# 样本太少时p95不可信，先不对冲
+HEDGE_MIN_SAMPLES = 20
+SAFE_HOSTS = ("e926.net",)
+
+
+class Upstream:
+    """一个API镜像的健康状况：延迟EWMA、耗时直方图和连续失败次数。"""
+
+    __slots__ = ("base_url", "safe", "latency", "histogram", "failures", "down_until")
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url if base_url.endswith("/") else f"{base_url}/"
+        host = urlsplit(self.base_url).hostname or ""
+        self.safe = any(
+            host == safe or host.endswith(f".{safe}") for safe in SAFE_HOSTS
+        )
+        self.latency = 0.0
+        self.histogram = Histogram()
+        self.failures = 0
+        self.down_until = 0.0
+
+    @property
+    def healthy(self):
+        return self.down_until <= time.monotonic()
+
+    def record(self, seconds: float, ok: bool):
+        self.histogram.observe(seconds, not ok)
+        self.latency = (
+            seconds if not self.latency else 0.8 * self.latency + 0.2 * seconds
+        )
+        if ok:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= FAILURE_THRESHOLD:
+            self.down_until = time.monotonic() + COOLDOWN_SECONDS
+
+    def hedge_delay(self) -> float | None:
+        if self.histogram.count < HEDGE_MIN_SAMPLES:
+            return None
+        return self.histogram.percentile(0.95)
+
+
+class UpstreamPool:
+    """按配置顺序排好的一组API镜像，挂掉的暂时跳过，全挂了就都试一遍。"""
+
+    def __init__(self, base_urls: list[str], hedge: bool, route_safe: bool):
+        self.upstreams = [Upstream(url) for url in base_urls]
+        self.hedge = hedge
+        self.route_safe = route_safe
+
+    @property
+    def primary(self) -> Upstream:
+        return self.upstreams[0]
+
+    def candidates(self, safe: bool = False) -> list[Upstream]:
+        upstreams = self.upstreams
+        if safe and self.route_safe:
+            # 分级限制为safe的群只走安全站，没配安全站就照常走
+            upstreams = [
+                upstream for upstream in upstreams if upstream.safe
+            ] or upstreams
+        healthy = [upstream for upstream in upstreams if upstream.healthy]
+        return healthy or upstreams
+
+    def route(self, url: str, safe: bool) -> str:
+        # 受限的群换成安全站的地址，缓存键也就跟着分开了
+        if not (safe and self.route_safe):
+            return url
+        upstream = next(
+            (upstream for upstream in self.upstreams if upstream.safe), None
+        )
+        return url if upstream is None else self.rebase(url, upstream)
+
+    def find(self, url: str) -> Upstream | None:
+        for upstream in self.upstreams:
+            if url.startswith(upstream.base_url):
+                return upstream
+        return None
+
+    def rebase(self, url: str, upstream: Upstream) -> str:
+        current = self.find(url)
+        if current is None or current is upstream:
+            return url
+        return upstream.base_url + url[len(current.base_url) :]
+
+    def hedge_delay(self, upstream: Upstream) -> float | None:
+        return upstream.hedge_delay() if self.hedge else None
+
+
+async def first_response(tasks: list[asyncio.Task]) -> httpx.Response:
+    """返回最先成功的响应，其余的取消；都失败就抛最后一个异常。"""
+    pending = set(tasks)
+    error: BaseException | None = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            winner = None
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                elif winner is None:
+                    winner = task.result()
+                else:
+                    # 两边同时返回，多出来的响应直接关掉
+                    await task.result().aclose()
+            if winner is not None:
+                return winner
+        assert error is not None
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
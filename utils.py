@@ -1,16 +1,18 @@
 import copy
-import json
+import importlib.util
 import os
-from typing import Literal, TypeVar
-from urllib.parse import unquote
+from typing import TypeVar
+from urllib.parse import parse_qs, unquote, urlsplit
 
-import aiocqhttp
 import httpx
 
 import astrbot.api.message_components as Comp
 
-from .constants import INITIAL_GROUP_DATA, PLUGIN_DATA_PATH, RATING_LEVEL
-from .parser import render_template
+from .constants import RATING_LEVEL
+from .metrics import metrics, timed
+from .models import Post
+from .parser import CompiledTemplate
+from .storage import STORE_BACKENDS, group_data_cache
 
 T = TypeVar("T")
 K = TypeVar("K")
@@ -20,50 +22,90 @@ def format_tags(tags: list[str]):
     return "+".join([x.replace(" ", "_") for x in tags])
 
 
+@timed("format_post")
 def format_post(
-    post: dict,
-    type: Literal["random"] | Literal["post"],
-    template: str,
+    post: Post,
+    template: CompiledTemplate,
     index: tuple[int, int] | None = None,
+    image_path: str | None = None,
 ) -> list[Comp.BaseMessageComponent]:
-    if type == "random":
-        file_url = post.get("file_url")
-    elif type == "post":
-        file: dict = post.get("file", {})
-        file_url = file.get("url")
+    file_url = post.file_url
+    with metrics.timer("render_template"):
+        text = template.render(post, {"RATING": RATING_LEVEL[post.rating]})
     result: list[Comp.BaseMessageComponent] = [
-        Comp.Plain(
-            render_template(
-                f"\n{template}",
-                post
-                | {
-                    "RATING": RATING_LEVEL[post["rating"]],
-                },
-            )
-        ),
+        Comp.Plain(text),
     ]
     try:
         result.insert(
             0,
-            Comp.Image.fromURL(file_url)
+            Comp.Image.fromFileSystem(image_path)
+            if image_path
+            else Comp.Image.fromURL(file_url)
             if file_url
             else Comp.Image.fromFileSystem(
                 os.path.join(os.path.dirname(__file__), "tip.png")
             ),
         )
-    except aiocqhttp.exceptions.NetworkError:
-        result = [
-            Comp.Plain(f"服务端下载图片失败，请使用view {post['id']}重新查看帖子。")
-        ]
+    except Exception as e:
+        # aiocqhttp导入要几百毫秒，真出错了才导入来判断
+        try:
+            from aiocqhttp.exceptions import NetworkError
+        except ImportError:
+            raise e
+        if not isinstance(e, NetworkError):
+            raise
+        result = [Comp.Plain(f"服务端下载图片失败，请使用view {post.id}重新查看帖子。")]
     if index:
         result.insert(0, Comp.Plain(f"第({index[0] + 1}/{index[1]})条帖子："))
     return result
 
 
+def summarize_post(post: Post, template: CompiledTemplate) -> str:
+    return template.render(post, {"RATING": RATING_LEVEL[post.rating]})
+
+
+def create_http_client(
+    user_agent: str,
+    max_connections: int,
+    max_keepalive_connections: int,
+    connect_timeout: float,
+    read_timeout: float,
+    pool_timeout: float,
+    http2: bool,
+) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        headers={"User-Agent": user_agent if user_agent else "RandomPostPlugin/1.0"},
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+        ),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout, pool=pool_timeout),
+        # HTTP/2要装h2才能用，没装就退回HTTP/1.1
+        http2=http2 and importlib.util.find_spec("h2") is not None,
+    )
+
+
 def merge_params(url: str, params: dict):
     return unquote(str(httpx.Request("GET", url, params=params).url))
 
 
+def get_query_limit(url: str) -> int | None:
+    limit = parse_qs(urlsplit(url).query).get("limit")
+    return int(limit[0]) if limit else None
+
+
+def has_order_tag(tags: str):
+    return any(tag.startswith("order:") for tag in tags.split("+"))
+
+
+def is_safe_query(tags: str):
+    return any(tag in ("rating:s", "rating:safe") for tag in tags.split("+"))
+
+
+def get_search_cursor_key(tags: str, count: int, page: int, blacklist: str):
+    return f"{count}:{page}:{blacklist}:{tags}"
+
+
 def filter_empty_string(array: list[T]) -> list[T]:
     return [v for v in array if v not in (None, "")]
 
@@ -74,26 +116,34 @@ def compose_rating_map(separator: str = ",\n"):
     )
 
 
-def get_group_data_path(group: str):
-    return PLUGIN_DATA_PATH / f"{group}.json"
+@timed("group_data.read")
+def read_group_data(group: str) -> dict:
+    # 返回副本，调用方改了也不会污染缓存
+    return copy.deepcopy(group_data_cache.get(group))
 
 
-def open_group_file(group: str, mode: str):
-    return open(get_group_data_path(group), mode, encoding="utf8")
+@timed("group_data.read")
+def read_group_value(group: str, key: str, default: object = None):
+    # 只拷贝要的这一个键，不连带最近发帖记录这种大列表一起深拷贝
+    return copy.deepcopy(group_data_cache.get(group).get(key, default))
 
 
-def read_group_data(group: str) -> dict:
-    path = get_group_data_path(group)
-    if not os.path.exists(path):
-        # 路径不存在的话就说明这个群第一次存取数据，肯定是写，直接返回默认值
-        return copy.deepcopy(INITIAL_GROUP_DATA)
-    with open_group_file(group, "r") as file:
-        return json.load(file)
-
-
-def write_group_data(group: str, key: str, value: object) -> dict:
-    data = read_group_data(group)
-    data[key] = value
-    with open_group_file(group, "w") as file:
-        json.dump(data, file, ensure_ascii=False)
-        return data
+@timed("group_data.write")
+def write_group_data(group: str, key: str, value: object):
+    group_data_cache.set(group, key, value)
+
+
+def configure_group_storage(backend: str):
+    group_data_cache.use_store(STORE_BACKENDS[backend]())
+
+
+async def load_group_data():
+    await group_data_cache.preload()
+
+
+async def flush_group_data():
+    await group_data_cache.flush()
+
+
+async def close_group_data():
+    await group_data_cache.close()